@@ -13,15 +13,41 @@
 #
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
+import contextlib
+import gzip
+import json
+import multiprocessing
+import os
+import sys
 import time
+from collections import defaultdict
 from datetime import datetime, timedelta
 
+import fedmsg.encoding
 import fedmsg.meta
 from fedmsg.commands import BaseCommand
 from fedmsg.encoding import pretty_dumps
-from sqlalchemy import func
+from sqlalchemy import func, select
 
 import datanommer.models as m
+import datanommer.models.search
+import datanommer.models.spool
+
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# The file extensions implying a compression for datanommer-dump --output.
+COMPRESSIONS = {".gz": "gzip", ".zst": "zstd"}
 
 
 class CreateCommand(BaseCommand):
@@ -34,11 +60,26 @@ class CreateCommand(BaseCommand):
 
 
 class DumpCommand(BaseCommand):
-    """Dump the contents of the datanommer database as JSON.
+    """Dump the contents of the datanommer database as JSON, one message per
+    line, to the standard output or to the file given with --output.
 
     You can also specify a timespan with the --since and --before arguments:
 
         $ datanommer-dump --before 2013-02-15 --since 2013-02-11T08:00:00 > datanommer-dump.json
+
+    The messages are fetched a chunk at a time, so the memory used doesn't grow
+    with the size of the dump.  It can be compressed with gzip or zstd (which
+    needs the zstandard module), as implied by the .gz and .zst extensions:
+
+        $ datanommer-dump --output datanommer-dump.json.zst
+
+    With --jobs, the id range of the messages is split in as many slices,
+    dumped in parallel by separate processes, each with its own database
+    connection, to the segment files of the --output directory.  Its
+    manifest.json, written last, lists the segments with their id ranges and
+    number of messages:
+
+        $ datanommer-dump --since 2013-01-01 --jobs 8 --compress zstd --output datanommer-dump/
     """
 
     name = "datanommer-dump"
@@ -59,22 +100,188 @@ class DumpCommand(BaseCommand):
                 "help": "Only before datetime, ex 2013-02-14T08:05:59.87",
             },
         ),
+        (
+            ["--output"],
+            {
+                "dest": "output",
+                "default": None,
+                "help": "Write to this file instead of the standard output",
+            },
+        ),
+        (
+            ["--compress"],
+            {
+                "dest": "compress",
+                "default": None,
+                "choices": ["gzip", "zstd"],
+                "help": "Compress the output, implied by the extension of --output",
+            },
+        ),
+        (
+            ["--chunk-size"],
+            {
+                "dest": "chunk_size",
+                "type": int,
+                "default": m.DEFAULT_CHUNK_SIZE,
+                "help": "Number of messages fetched from the database at a time",
+            },
+        ),
+        (
+            ["--jobs"],
+            {
+                "dest": "jobs",
+                "type": int,
+                "default": 1,
+                "help": "Number of processes dumping slices of the messages to the "
+                + "--output directory",
+            },
+        ),
     ]
 
     def run(self):
         m.init(self.config["datanommer.sqlalchemy.url"])
         config = self.config
+        since, before = config.get("since", None), config.get("before", None)
+
+        path = config.get("output", None)
+        compression = config.get("compress", None)
+        if compression is None and path is not None:
+            compression = COMPRESSIONS.get(os.path.splitext(path)[1])
+        if compression == "zstd" and zstandard is None:
+            self.log.error("Compressing with zstd needs the zstandard module")
+            return
+
+        chunk_size = config.get("chunk_size", m.DEFAULT_CHUNK_SIZE)
+        jobs = config.get("jobs", 1)
+        if jobs > 1:
+            if path is None:
+                self.log.error("Dumping with --jobs needs an --output directory")
+                return
+            manifest = self.dump_segments(
+                path, jobs, since, before, compression, chunk_size
+            )
+            self.log.info(
+                "Dumped %d messages in %d segments to %s"
+                % (manifest["messages"], len(manifest["segments"]), path)
+            )
+            return
+
+        query = _dump_query(since, before).order_by(m.Message.id)
+        with _open_output(path, compression) as output:
+            count = _dump(query, output, chunk_size)
+        if path is not None:
+            self.log.info("Dumped %d messages to %s" % (count, path))
+
+    def dump_segments(self, path, jobs, since, before, compression, chunk_size):
+        """Dump the messages to a segment of the path directory per slice of
+        their ids, in jobs processes, and return the manifest.
+        """
+        query = _dump_query(since, before).with_entities(
+            func.min(m.Message.id), func.max(m.Message.id)
+        )
+        first, last = query.one()
+        # The processes open their own connections.
+        m.session.close()
+
+        suffix = {"gzip": ".gz", "zstd": ".zst"}.get(compression, "")
+        segments = []
+        if first is not None:
+            step = (last - first) // jobs + 1
+            for index, start in enumerate(range(first, last + 1, step)):
+                segments.append(
+                    {
+                        "path": f"segment-{index:04d}.json{suffix}",
+                        "first_id": start,
+                        "last_id": min(start + step - 1, last),
+                    }
+                )
 
-        query = m.Message.query
-        if config.get("before", None):
-            query = query.filter(m.Message.timestamp <= config.get("before"))
-
-        if config.get("since", None):
-            query = query.filter(m.Message.timestamp >= config.get("since"))
-
-        results = query.all()
-
-        self.log.info(pretty_dumps(results))
+        os.makedirs(path, exist_ok=True)
+        url = self.config["datanommer.sqlalchemy.url"]
+        arguments = [
+            (
+                url,
+                since,
+                before,
+                segment["first_id"],
+                segment["last_id"],
+                os.path.join(path, segment["path"]),
+                compression,
+                chunk_size,
+            )
+            for segment in segments
+        ]
+        # Spawn rather than fork, so that no connection is shared.
+        with multiprocessing.get_context("spawn").Pool(jobs) as pool:
+            counts = pool.starmap(_dump_segment, arguments)
+        for segment, count in zip(segments, counts):
+            segment["messages"] = count
+
+        manifest = {
+            "since": since,
+            "before": before,
+            "compression": compression,
+            "messages": sum(counts),
+            "segments": segments,
+        }
+        with open(os.path.join(path, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+        return manifest
+
+
+def _dump_query(since=None, before=None):
+    query = m.Message.query
+    if before:
+        query = query.filter(m.Message.timestamp <= before)
+
+    if since:
+        query = query.filter(m.Message.timestamp >= since)
+    return query
+
+
+def _dump_segment(url, since, before, first_id, last_id, path, compression, chunk_size):
+    """Dump the messages with ids from first_id to last_id to the segment at
+    path, in a process of datanommer-dump --jobs, and return their number.
+    """
+    m.init(url)
+    query = _dump_query(since, before).filter(m.Message.id.between(first_id, last_id))
+    try:
+        with _open_output(path, compression) as output:
+            return _dump(query.order_by(m.Message.id), output, chunk_size)
+    finally:
+        m.session.remove()
+
+
+@contextlib.contextmanager
+def _open_output(path, compression=None):
+    """Open the file to dump to for writing bytes, or the standard output if
+    path is None, compressed with "gzip", "zstd" or nothing.
+    """
+    with contextlib.ExitStack() as stack:
+        if path is None:
+            output = sys.stdout.buffer
+        else:
+            output = stack.enter_context(open(path, "wb"))
+        # The compressor is closed first, and doesn't close the file.
+        if compression == "gzip":
+            output = stack.enter_context(gzip.GzipFile(fileobj=output, mode="wb"))
+        elif compression == "zstd":
+            writer = zstandard.ZstdCompressor().stream_writer(output, closefd=False)
+            output = stack.enter_context(writer)
+        yield output
+
+
+def _dump(query, output, chunk_size):
+    """Write the messages of the query to output as JSON Lines and return
+    their number.  They are fetched chunk_size at a time (with a server-side
+    cursor on PostgreSQL) and expunged from the session once written.
+    """
+    count = 0
+    for message in query.yield_per(chunk_size):
+        output.write(fedmsg.encoding.dumps(message).encode("utf-8") + b"\n")
+        m.session.expunge(message)
+        count += 1
+    return count
 
 
 class StatsCommand(BaseCommand):
@@ -314,32 +521,27 @@ class LatestCommand(BaseCommand):
         m.init(self.config["datanommer.sqlalchemy.url"])
         config = self.config
 
-        if config.get("topic", None):
-            queries = [m.Message.query.filter(m.Message.topic == config.get("topic"))]
+        # Only show messages from the last year
+        a_year = timedelta(days=365)
+        earliest = datetime.utcnow() - a_year
 
+        # The latest messages are recorded as they are stored, so these are
+        # lookups by topic or category rather than searches of the messages.
+        if config.get("topic", None):
+            messages = m.Message.latest_by_topic([config.get("topic")], since=earliest)
         elif config.get("category", None):
-            queries = [
-                m.Message.query.filter(m.Message.category == config.get("category"))
-            ]
+            messages = m.Message.latest_by_category(
+                [config.get("category")], since=earliest
+            )
         elif not config.get("overall", False):
             # If no args..
             fedmsg.meta.make_processors(**config)
             categories = [p.__name__.lower() for p in fedmsg.meta.processors]
-            queries = [
-                m.Message.query.filter(m.Message.category == category)
-                for category in categories
-            ]
+            messages = m.Message.latest_by_category(categories, since=earliest)
         else:
             # Show only the single latest message, regardless of type.
-            queries = [m.Message.query]
-
-        # Only check messages from the last year to speed up queries
-        a_year = timedelta(days=365)
-        earliest = datetime.utcnow() - a_year
-        queries = [q.filter(m.Message.timestamp > earliest) for q in queries]
-
-        # Order and limit to the latest.
-        queries = [q.order_by(m.Message.timestamp.desc()).limit(1) for q in queries]
+            messages = m.Message.latest_by_category(since=earliest)
+            messages = sorted(messages, key=lambda message: message.timestamp)[-1:]
 
         def formatter(key, val):
             if config.get("timestamp", None) and config.get("human", None):
@@ -355,12 +557,370 @@ class LatestCommand(BaseCommand):
                 return f"{{{pretty_dumps(key)}: {pretty_dumps(val)}}}"
 
         results = []
-        for result in sum((query.all() for query in queries), []):
+        for result in messages:
             results.append(formatter(result.category, result))
 
         self.log.info("[%s]" % ",".join(results))
 
 
+class SpoolCommand(BaseCommand):
+    """Inspect or replay the messages spooled by the consumer in
+    'datanommer.spool.path' while the database was unavailable.
+
+    By default, list the segments of the spool with their number of messages.
+    Print the messages of a segment with --show, or store the messages of all
+    the closed segments in the database with --replay:
+
+        $ datanommer-spool --replay
+    """
+
+    name = "datanommer-spool"
+    extra_args = [
+        (
+            ["--path"],
+            {
+                "dest": "spool_path",
+                "default": None,
+                "help": "The spool directory, instead of 'datanommer.spool.path'",
+            },
+        ),
+        (
+            ["--show"],
+            {
+                "dest": "show",
+                "default": None,
+                "help": "Print the messages of this segment file as JSON",
+            },
+        ),
+        (
+            ["--replay"],
+            {
+                "dest": "replay",
+                "default": False,
+                "action": "store_true",
+                "help": "Store the spooled messages in the database and delete "
+                + "their segments.",
+            },
+        ),
+        (
+            ["--batch-size"],
+            {
+                "dest": "batch_size",
+                "type": int,
+                "default": 1000,
+                "help": "Number of messages stored per transaction with --replay",
+            },
+        ),
+    ]
+
+    def run(self):
+        config = self.config
+        path = config.get("spool_path") or config.get("datanommer.spool.path")
+        spool = datanommer.models.spool
+
+        if config.get("show", None):
+            self.log.info(pretty_dumps(list(spool.read(config.get("show")))))
+            return
+
+        if not path:
+            self.log.error("No spool given with --path or 'datanommer.spool.path'")
+            return
+
+        if config.get("replay", False):
+            m.init(self.config["datanommer.sqlalchemy.url"])
+            count = spool.replay(path, spool.store, config.get("batch_size", 1000))
+            self.log.info("Replayed %d messages" % count)
+            return
+
+        for segment in spool.segments(path, include_open=True):
+            status = " (open)" if segment.endswith(spool.OPEN_SUFFIX) else ""
+            count = sum(1 for envelope in spool.read(segment))
+            self.log.info("%s: %d messages%s" % (segment, count, status))
+
+
+class SearchIndexCommand(BaseCommand):
+    """Index the messages stored before the full-text index used by
+    'Message.grep(search=...)' was created, a chunk of message ids at a time.
+
+    The index is only created on request, by the alembic migrations with
+    "-x search_index=true", or with --create:
+
+        $ datanommer-search-index --create
+
+    With PostgreSQL, the GIN index of the messages is then built concurrently,
+    once they are all indexed.  The trigram index used by
+    'Message.grep(contains=...)' can also be built concurrently, with
+    PostgreSQL only, when it wasn't created by the alembic migrations:
+
+        $ datanommer-search-index --trigram
+    """
+
+    name = "datanommer-search-index"
+    extra_args = [
+        (
+            ["--create"],
+            {
+                "dest": "create",
+                "default": False,
+                "action": "store_true",
+                "help": "Create the full-text index before filling it.",
+            },
+        ),
+        (
+            ["--trigram"],
+            {
+                "dest": "trigram",
+                "default": False,
+                "action": "store_true",
+                "help": "Only build the trigram index of the messages.",
+            },
+        ),
+        (
+            ["--chunk-size"],
+            {
+                "dest": "chunk_size",
+                "type": int,
+                "default": datanommer.models.search.DEFAULT_CHUNK_SIZE,
+                "help": "Number of message ids indexed per transaction",
+            },
+        ),
+    ]
+
+    def run(self):
+        m.init(self.config["datanommer.sqlalchemy.url"])
+        search = datanommer.models.search
+
+        if self.config.get("trigram", False):
+            if m.session.bind.dialect.name != "postgresql":
+                self.log.error("Trigram indexes are only supported with PostgreSQL")
+                return
+            with m.session.bind.connect() as connection:
+                connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+                search.create_trigram_index(connection)
+            self.log.info("Built the trigram index")
+            return
+
+        if self.config.get("create", False) and not search.exists(m.session.bind):
+            search.create(m.session.connection())
+            m.session.commit()
+
+        chunk_size = self.config.get("chunk_size", search.DEFAULT_CHUNK_SIZE)
+        count = search.backfill(chunk_size)
+        self.log.info("Indexed %d messages" % count)
+
+        with m.session.bind.connect() as connection:
+            search.create_index(
+                connection.execution_options(isolation_level="AUTOCOMMIT")
+            )
+
+
+class ExportCommand(BaseCommand):
+    """Export the messages of the datanommer database to a Parquet (or Arrow)
+    file for analysis, which needs the pyarrow module.
+
+    The messages are ordered by timestamp and fetched --batch-size at a time,
+    and each row group only holds messages of the same month.  The JSON of
+    the messages and of their headers is kept as strings, the users and
+    packages of the messages are lists.  You can also specify a timespan with
+    the --since and --before arguments:
+
+        $ datanommer-export --since 2021-01-01 --output datanommer-2021.parquet
+
+    With --partition, --output is a directory and each month is written to
+    its own file, in month=YYYY-MM subdirectories (Hive partitioning):
+
+        $ datanommer-export --partition --output datanommer/
+    """
+
+    name = "datanommer-export"
+    extra_args = [
+        (
+            ["--since"],
+            {
+                "dest": "since",
+                "default": None,
+                "help": "Only after datetime, ex 2013-02-14T08:05:59.87",
+            },
+        ),
+        (
+            ["--before"],
+            {
+                "dest": "before",
+                "default": None,
+                "help": "Only before datetime, ex 2013-02-14T08:05:59.87",
+            },
+        ),
+        (
+            ["--output"],
+            {
+                "dest": "output",
+                "default": None,
+                "help": "The file to export to",
+            },
+        ),
+        (
+            ["--format"],
+            {
+                "dest": "format",
+                "default": "parquet",
+                "choices": ["parquet", "arrow"],
+                "help": "Write a Parquet file, or an Arrow IPC file",
+            },
+        ),
+        (
+            ["--partition"],
+            {
+                "dest": "partition",
+                "default": False,
+                "action": "store_true",
+                "help": "Write a file per month in the --output directory",
+            },
+        ),
+        (
+            ["--batch-size"],
+            {
+                "dest": "batch_size",
+                "type": int,
+                "default": 10000,
+                "help": "Maximum number of messages fetched and written at a time",
+            },
+        ),
+    ]
+
+    def run(self):
+        config = self.config
+        if pyarrow is None:
+            self.log.error("Exporting the messages needs the pyarrow module")
+            return
+        path = config.get("output", None)
+        if not path:
+            self.log.error("No file to export to given with --output")
+            return
+
+        m.init(self.config["datanommer.sqlalchemy.url"])
+        messages = m.Message.__table__
+        query = select(
+            [
+                messages.c.id,
+                messages.c.msg_id,
+                messages.c.timestamp,
+                messages.c.topic,
+                messages.c.category,
+                messages.c.username,
+                messages.c._msg,
+                messages.c._headers,
+            ]
+        )
+        if config.get("before", None):
+            query = query.where(messages.c.timestamp <= config.get("before"))
+        if config.get("since", None):
+            query = query.where(messages.c.timestamp >= config.get("since"))
+        query = query.order_by(messages.c.timestamp, messages.c.id)
+
+        schema = _export_schema()
+        file_format = config.get("format", "parquet")
+        partition = config.get("partition", False)
+        writer = None if partition else _export_writer(path, file_format, schema)
+        month = None
+        count = 0
+        try:
+            batch_size = config.get("batch_size", 10000)
+            # Each table is written as a row group (or a record batch).
+            for rows in _export_batches(query, batch_size):
+                timestamp = rows[0].timestamp
+                if partition and (timestamp.year, timestamp.month) != month:
+                    # The messages are ordered by timestamp, so each month is
+                    # done when the next one starts.
+                    if writer is not None:
+                        writer.close()
+                    month = (timestamp.year, timestamp.month)
+                    directory = os.path.join(path, "month=%04d-%02d" % month)
+                    os.makedirs(directory, exist_ok=True)
+                    writer = _export_writer(
+                        os.path.join(directory, "part-0.%s" % file_format),
+                        file_format,
+                        schema,
+                    )
+                writer.write_table(_export_table(rows, schema))
+                count += len(rows)
+        finally:
+            if writer is not None:
+                writer.close()
+        self.log.info("Exported %d messages to %s" % (count, path))
+
+
+def _export_writer(path, file_format, schema):
+    if file_format == "arrow":
+        return pyarrow.ipc.new_file(path, schema)
+    return pyarrow.parquet.ParquetWriter(path, schema)
+
+
+def _export_schema():
+    return pyarrow.schema(
+        [
+            ("id", pyarrow.int64()),
+            ("msg_id", pyarrow.string()),
+            ("timestamp", pyarrow.timestamp("us", tz="UTC")),
+            ("topic", pyarrow.string()),
+            ("category", pyarrow.string()),
+            ("username", pyarrow.string()),
+            ("msg", pyarrow.string()),
+            ("headers", pyarrow.string()),
+            ("users", pyarrow.list_(pyarrow.string())),
+            ("packages", pyarrow.list_(pyarrow.string())),
+        ]
+    )
+
+
+def _export_batches(query, batch_size):
+    """Yield the rows of the query in lists of at most batch_size rows of the
+    same month, fetched with a server-side cursor on PostgreSQL.
+    """
+    connection = m.session.connection().execution_options(stream_results=True)
+    for partition in connection.execute(query).partitions(batch_size):
+        start = 0
+        months = [(row.timestamp.year, row.timestamp.month) for row in partition]
+        for index in range(1, len(partition) + 1):
+            if index == len(partition) or months[index] != months[start]:
+                yield partition[start:index]
+                start = index
+
+
+def _export_table(rows, schema):
+    """Build the table of the rows of messages, with the users and packages
+    of the messages.
+    """
+    ids = [row.id for row in rows]
+    lists = {}
+    for name, column in (
+        ("users", m.user_assoc_table.c.username),
+        ("packages", m.pack_assoc_table.c.package),
+    ):
+        names = defaultdict(list)
+        # Stay below the limit of bound parameters of the database.
+        for chunk in m._chunks(ids, m._max_bound_parameters()):
+            query = select([column.table.c.msg, column]).where(
+                column.table.c.msg.in_(chunk)
+            )
+            for msg, value in m.session.execute(query):
+                names[msg].append(value)
+        lists[name] = [sorted(names[id_]) for id_ in ids]
+
+    columns = {
+        "id": ids,
+        "msg_id": [row.msg_id for row in rows],
+        "timestamp": [row.timestamp for row in rows],
+        "topic": [row.topic for row in rows],
+        "category": [row.category for row in rows],
+        "username": [row.username for row in rows],
+        "msg": [row._msg for row in rows],
+        "headers": [row._headers for row in rows],
+        "users": lists["users"],
+        "packages": lists["packages"],
+    }
+    return pyarrow.Table.from_pydict(columns, schema=schema)
+
+
 def create():
     command = CreateCommand()
     command.execute()
@@ -379,3 +939,18 @@ def stats():
 def latest():
     command = LatestCommand()
     command.execute()
+
+
+def spool():
+    command = SpoolCommand()
+    command.execute()
+
+
+def search_index():
+    command = SearchIndexCommand()
+    command.execute()
+
+
+def export():
+    command = ExportCommand()
+    command.execute()
@@ -13,17 +13,36 @@
 #
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
+import gzip
+import io
 import json
+import os
+import shutil
+import tempfile
 import time
 import unittest
 from datetime import datetime, timedelta
 from unittest.mock import Mock, patch
 
 import fedmsg.config
+import fedmsg.meta
 from sqlalchemy.orm import scoped_session
 
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 import datanommer.commands
 import datanommer.models as m
+import datanommer.models.spool
 
 
 filename = ":memory:"
@@ -41,8 +60,8 @@ class TestCommands(unittest.TestCase):
         m.session.rollback()
         engine = m.session.get_bind()
         m.DeclarativeBase.metadata.drop_all(engine)
-        m._users_seen = set()
-        m._packages_seen = set()
+        m._users_seen.clear()
+        m._packages_seen.clear()
 
     def test_stats(self):
         with patch("datanommer.commands.StatsCommand.get_config") as gc:
@@ -199,53 +218,246 @@ class TestCommands(unittest.TestCase):
                 in logged_info
             )
 
-    def test_dump(self):
-        m.Message = datanommer.models.Message
-        now = datetime.utcnow()
+    def dump_path(self, name="datanommer-dump.json"):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        return os.path.join(path, name)
+
+    def read_dump(self, path, opener=open):
+        with opener(path, "rt") as dump:
+            return [json.loads(line) for line in dump]
 
+    def add_dump_messages(self):
+        now = datetime.utcnow()
         msg1 = m.Message(
-            topic="org.fedoraproject.prod.git.branch.valgrind.master", timestamp=now
+            topic="org.fedoraproject.prod.git.branch.valgrind.master",
+            timestamp=now,
+            i=1,
         )
-
         msg2 = m.Message(
-            topic="org.fedoraproject.prod.git.receive.valgrind.master", timestamp=now
+            topic="org.fedoraproject.prod.git.receive.valgrind.master",
+            timestamp=now,
+            i=2,
         )
-
         msg1.msg = "Message 1"
         msg2.msg = "Message 2"
-        objects = [msg1, msg2]
+        m.session.add_all([msg1, msg2])
+        m.session.flush()
+
+    def test_dump(self):
+        self.add_dump_messages()
+
+        with patch("datanommer.commands.DumpCommand.get_config") as gc:
+            gc.return_value = self.config
+            command = datanommer.commands.DumpCommand()
+            stdout = Mock(buffer=io.BytesIO())
+            with patch("datanommer.commands.sys.stdout", stdout):
+                command.run()
 
-        models = [m.Message]
+        lines = stdout.buffer.getvalue().decode("utf-8").splitlines()
+        messages = [json.loads(line) for line in lines]
+        assert len(messages) == 2
+        assert (
+            messages[0]["topic"] == "org.fedoraproject.prod.git.branch.valgrind.master"
+        )
+        assert messages[0]["msg"] == "Message 1"
+        assert (
+            messages[1]["topic"] == "org.fedoraproject.prod.git.receive.valgrind.master"
+        )
 
-        with patch("datanommer.models.models", models):
-            with patch("datanommer.models.Message.query"):
-                m.Message.query.all = Mock(return_value=objects)
+    def test_dump_gzip(self):
+        self.add_dump_messages()
+        path = self.dump_path("datanommer-dump.json.gz")
 
-                with patch("datanommer.commands.DumpCommand.get_config") as gc:
-                    gc.return_value = self.config
+        with patch("datanommer.commands.DumpCommand.get_config") as gc:
+            self.config["output"] = path
+            self.config["chunk_size"] = 1
+            gc.return_value = self.config
+            command = datanommer.commands.DumpCommand()
+            command.run()
 
-                    command = datanommer.commands.DumpCommand()
+        messages = self.read_dump(path, gzip.open)
+        assert [message["i"] for message in messages] == [1, 2]
+        # The messages were expunged as they were written.
+        assert len(m.session.identity_map) == 0
 
-                    logged_info = []
+    @unittest.skipIf(zstandard is None, "needs zstandard")
+    def test_dump_zstd(self):
+        self.add_dump_messages()
+        path = self.dump_path()
 
-                    def info(data):
-                        logged_info.append(data)
+        with patch("datanommer.commands.DumpCommand.get_config") as gc:
+            self.config["output"] = path
+            self.config["compress"] = "zstd"
+            gc.return_value = self.config
+            command = datanommer.commands.DumpCommand()
+            command.run()
 
-                    command.log.info = info
-                    command.run()
+        def opener(path, mode):
+            reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+            return io.TextIOWrapper(reader, encoding="utf-8")
 
-                    json_object = json.loads(logged_info[0])
+        messages = self.read_dump(path, opener)
+        assert [message["i"] for message in messages] == [1, 2]
 
-                    assert (
-                        json_object[0]["topic"]
-                        == "org.fedoraproject.prod.git.branch.valgrind.master"
-                    )
+    def test_dump_jobs(self):
+        path = self.dump_path("datanommer.db")
+        uri = "sqlite:///%s" % path
+        m.session = scoped_session(m.maker)
+        m.init(uri=uri, create=True)
+        for i in range(10):
+            msg = m.Message(
+                topic="org.fedoraproject.prod.git.receive.valgrind.master",
+                timestamp=datetime(2013, 2, 14 + i),
+                i=i,
+            )
+            msg.msg = "Message %d" % i
+            m.session.add(msg)
+        m.session.commit()
+
+        output = os.path.join(os.path.dirname(path), "dump")
+        with patch("datanommer.commands.DumpCommand.get_config") as gc:
+            self.config["datanommer.sqlalchemy.url"] = uri
+            self.config["since"] = "2013-02-15"
+            self.config["output"] = output
+            self.config["compress"] = "gzip"
+            self.config["jobs"] = 3
+            gc.return_value = self.config
+            command = datanommer.commands.DumpCommand()
+            command.run()
+
+        with open(os.path.join(output, "manifest.json")) as f:
+            manifest = json.load(f)
+        assert manifest["messages"] == 9
+        assert [s["messages"] for s in manifest["segments"]] == [3, 3, 3]
+        assert manifest["segments"][0]["path"] == "segment-0000.json.gz"
+        assert manifest["segments"][0]["first_id"] == 2
+        assert manifest["segments"][-1]["last_id"] == 10
+        messages = []
+        for segment in manifest["segments"]:
+            segment_path = os.path.join(output, segment["path"])
+            messages.extend(self.read_dump(segment_path, gzip.open))
+        assert [message["i"] for message in messages] == list(range(1, 10))
+
+    def add_export_messages(self):
+        times = [datetime(2013, 1, 30), datetime(2013, 1, 31), datetime(2013, 2, 1)]
+        for i, timestamp in enumerate(times):
+            msg = m.Message(
+                topic="org.fedoraproject.prod.git.receive.valgrind.master",
+                category="git",
+                timestamp=timestamp,
+                msg_id="msg-%d" % i,
+                i=i,
+            )
+            msg.msg = {"commit": {"repo": "valgrind"}}
+            msg.users = [m.User.get_or_create("ralph")]
+            if i == 0:
+                msg.users.append(m.User.get_or_create("toshio"))
+                msg.packages = [m.Package.get_or_create("valgrind")]
+            m.session.add(msg)
+        m.session.flush()
+
+    @unittest.skipIf(pyarrow is None, "needs pyarrow")
+    def test_export(self):
+        self.add_export_messages()
+        path = self.dump_path("datanommer.parquet")
+
+        with patch("datanommer.commands.ExportCommand.get_config") as gc:
+            self.config["output"] = path
+            self.config["batch_size"] = 10
+            gc.return_value = self.config
+            command = datanommer.commands.ExportCommand()
+            command.run()
+
+        parquet = pyarrow.parquet.ParquetFile(path)
+        # A row group per month.
+        assert parquet.num_row_groups == 2
+        assert parquet.metadata.row_group(0).num_rows == 2
+        table = parquet.read()
+        assert table.column("msg_id").to_pylist() == ["msg-0", "msg-1", "msg-2"]
+        assert table.column("category").to_pylist() == ["git"] * 3
+        assert json.loads(table.column("msg")[0].as_py()) == {
+            "commit": {"repo": "valgrind"}
+        }
+        assert table.column("users").to_pylist() == [
+            ["ralph", "toshio"],
+            ["ralph"],
+            ["ralph"],
+        ]
+        assert table.column("packages").to_pylist() == [["valgrind"], [], []]
+        timestamp = table.column("timestamp")[2].as_py()
+        assert timestamp.replace(tzinfo=None) == datetime(2013, 2, 1)
+
+    @unittest.skipIf(pyarrow is None, "needs pyarrow")
+    def test_export_arrow(self):
+        self.add_export_messages()
+        path = self.dump_path("datanommer.arrow")
+
+        with patch("datanommer.commands.ExportCommand.get_config") as gc:
+            self.config["output"] = path
+            self.config["format"] = "arrow"
+            self.config["since"] = "2013-01-31"
+            self.config["batch_size"] = 1
+            gc.return_value = self.config
+            command = datanommer.commands.ExportCommand()
+            command.run()
+
+        with pyarrow.ipc.open_file(path) as reader:
+            assert reader.num_record_batches == 2
+            table = reader.read_all()
+        assert table.column("msg_id").to_pylist() == ["msg-1", "msg-2"]
+
+    @unittest.skipIf(pyarrow is None, "needs pyarrow")
+    def test_export_bound_parameters(self):
+        self.add_export_messages()
+        path = self.dump_path("datanommer.parquet")
+
+        # A batch of more messages than the database accepts parameters.
+        with patch("datanommer.commands.ExportCommand.get_config") as gc, patch(
+            "datanommer.models._max_bound_parameters", return_value=2
+        ):
+            self.config["output"] = path
+            self.config["batch_size"] = 10
+            gc.return_value = self.config
+            command = datanommer.commands.ExportCommand()
+            command.run()
+
+        table = pyarrow.parquet.read_table(path)
+        assert table.column("users").to_pylist() == [
+            ["ralph", "toshio"],
+            ["ralph"],
+            ["ralph"],
+        ]
+        assert table.column("packages").to_pylist() == [["valgrind"], [], []]
+
+    @unittest.skipIf(pyarrow is None, "needs pyarrow")
+    def test_export_partition(self):
+        self.add_export_messages()
+        path = os.path.dirname(self.dump_path())
+
+        with patch("datanommer.commands.ExportCommand.get_config") as gc:
+            self.config["output"] = path
+            self.config["partition"] = True
+            self.config["batch_size"] = 1
+            gc.return_value = self.config
+            command = datanommer.commands.ExportCommand()
+            command.run()
+
+        assert sorted(os.listdir(path)) == ["month=2013-01", "month=2013-02"]
+        january = os.path.join(path, "month=2013-01", "part-0.parquet")
+        parquet = pyarrow.parquet.ParquetFile(january)
+        assert parquet.num_row_groups == 2
+        table = parquet.read()
+        assert table.column("msg_id").to_pylist() == ["msg-0", "msg-1"]
+        table = pyarrow.parquet.read_table(path)
+        assert table.num_rows == 3
 
     def test_dump_before(self):
         m.Message = datanommer.models.Message
 
         with patch("datanommer.commands.DumpCommand.get_config") as gc:
             self.config["before"] = "2013-02-16"
+            self.config["output"] = self.dump_path()
             gc.return_value = self.config
 
             time1 = datetime(2013, 2, 14)
@@ -290,7 +502,7 @@ class TestCommands(unittest.TestCase):
                 mock_dt.now.return_value = datetime(2013, 3, 1)
                 command.run()
 
-            json_object = json.loads(logged_info[0])
+            json_object = self.read_dump(self.config["output"])
 
             assert (
                 json_object[0]["topic"]
@@ -305,6 +517,7 @@ class TestCommands(unittest.TestCase):
     def test_dump_since(self):
         with patch("datanommer.commands.DumpCommand.get_config") as gc:
             self.config["since"] = "2013-02-14T08:00:00"
+            self.config["output"] = self.dump_path()
             gc.return_value = self.config
 
             time1 = datetime(2013, 2, 14)
@@ -349,7 +562,7 @@ class TestCommands(unittest.TestCase):
                 mock_dt.now.return_value = datetime(2013, 3, 1)
                 command.run()
 
-            json_object = json.loads(logged_info[0])
+            json_object = self.read_dump(self.config["output"])
 
             assert (
                 json_object[0]["topic"]
@@ -365,6 +578,7 @@ class TestCommands(unittest.TestCase):
         with patch("datanommer.commands.DumpCommand.get_config") as gc:
             self.config["before"] = "2013-02-16"
             self.config["since"] = "2013-02-14T08:00:00"
+            self.config["output"] = self.dump_path()
             gc.return_value = self.config
 
             time1 = datetime(2013, 2, 14)
@@ -409,7 +623,7 @@ class TestCommands(unittest.TestCase):
                 mock_dt.now.return_value = datetime(2013, 3, 1)
                 command.run()
 
-            json_object = json.loads(logged_info[0])
+            json_object = self.read_dump(self.config["output"])
 
             assert (
                 json_object[0]["topic"]
@@ -814,3 +1028,82 @@ class TestCommands(unittest.TestCase):
             assert json_object[1]["git"]["msg"] == "Message 3"
             assert json_object[0]["fas"]["msg"] == "Message 2"
             assert len(json_object) == 2
+
+    def test_spool(self):
+        fedmsg.meta.make_processors(**self.config)
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        spool = datanommer.models.spool.Spool(path)
+        for msg_id in ("1", "2"):
+            spool.append(
+                {
+                    "body": {
+                        "topic": "org.fedoraproject.prod.git.receive.valgrind.master",
+                        "i": 1,
+                        "msg_id": msg_id,
+                        "timestamp": 1344350850,
+                        "msg": {"foo": "bar"},
+                    }
+                }
+            )
+
+        def run(**options):
+            logged_info = []
+            with patch("datanommer.commands.SpoolCommand.get_config") as gc:
+                gc.return_value = dict(self.config, spool_path=path, **options)
+                command = datanommer.commands.SpoolCommand()
+                command.log.info = logged_info.append
+                command.run()
+            return logged_info
+
+        (segment,) = datanommer.models.spool.segments(path, include_open=True)
+        assert run() == ["%s: 2 messages (open)" % segment]
+
+        # The open segment is left alone until the consumer closes it.
+        assert run(replay=True) == ["Replayed 0 messages"]
+        spool.close()
+        (segment,) = datanommer.models.spool.segments(path)
+        assert run() == ["%s: 2 messages" % segment]
+
+        json_object = json.loads(run(show=segment)[0])
+        assert [envelope["body"]["msg_id"] for envelope in json_object] == ["1", "2"]
+
+        assert run(replay=True) == ["Replayed 2 messages"]
+        assert m.Message.query.count() == 2
+        assert run() == []
+
+    def test_search_index(self):
+        fedmsg.meta.make_processors(**self.config)
+        for msg_id in ("1", "2"):
+            m.add(
+                {
+                    "body": {
+                        "topic": "org.fedoraproject.prod.git.receive.valgrind.master",
+                        "i": 1,
+                        "msg_id": msg_id,
+                        "timestamp": 1344350850,
+                        "msg": {"foo": f"bar{msg_id}"},
+                    }
+                }
+            )
+
+        logged_info = []
+        with patch("datanommer.commands.SearchIndexCommand.get_config") as gc:
+            gc.return_value = dict(self.config, create=True, chunk_size=1)
+            command = datanommer.commands.SearchIndexCommand()
+            command.log.info = logged_info.append
+            command.run()
+
+        assert logged_info == ["Indexed 2 messages"]
+        t, p, r = m.Message.grep(search=["bar2"])
+        assert [message.msg_id for message in r] == ["2"]
+
+    def test_search_index_trigram(self):
+        logged_error = []
+        with patch("datanommer.commands.SearchIndexCommand.get_config") as gc:
+            gc.return_value = dict(self.config, trigram=True)
+            command = datanommer.commands.SearchIndexCommand()
+            command.log.error = logged_error.append
+            command.run()
+
+        assert logged_error == ["Trigram indexes are only supported with PostgreSQL"]
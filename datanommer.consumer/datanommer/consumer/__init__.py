@@ -13,12 +13,22 @@
 #
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
+import concurrent.futures
 import logging
+import multiprocessing
+import queue
+import sys
+import threading
+import time
 
 import fedmsg
 import fedmsg.consumers
+import fedmsg.meta
+import moksha.hub.reactor
+from twisted.internet.task import LoopingCall
 
 import datanommer.models
+import datanommer.models.spool
 
 
 DEFAULTS = {
@@ -26,12 +36,51 @@ DEFAULTS = {
     # Put a sqlite db in the current working directory if the user doesn't
     # specify a real location.
     "datanommer.sqlalchemy.url": "sqlite:///datanommer.db",
+    # How messages are serialized in the database, see datanommer.models.CODECS.
+    "datanommer.codec": "fedmsg",
+    # Group messages in transactions of up to this many messages. The default
+    # of 1 commits every message as soon as it is received.
+    "datanommer.batch.size": 1,
+    # Maximum number of seconds a message can wait in a batch before being
+    # committed.
+    "datanommer.batch.max_delay": 1.0,
+    # Number of users and packages remembered as existing in the database.
+    "datanommer.cache.size": datanommer.models.DEFAULT_CACHE_SIZE,
+    # At startup, remember the users and packages of this many recent messages.
+    "datanommer.cache.preload": 0,
+    # Number of workers preparing messages (serialization and fedmsg.meta
+    # processing) in parallel to the database writes. The default of 0 does
+    # everything in the hub's worker threads.
+    "datanommer.pipeline.workers": 0,
+    # Whether the workers are threads ("thread") or processes ("process").
+    # Processes require Python 3.7 or later.
+    "datanommer.pipeline.executor": "thread",
+    # Maximum number of messages waiting to be written. When it is reached,
+    # the consumer stops accepting messages until the writer catches up.
+    "datanommer.pipeline.queue_size": 1000,
+    # Directory where messages are spooled while the database is unavailable
+    # or slow. The default of None disables the spool.
+    "datanommer.spool.path": None,
+    "datanommer.spool.segment_size": datanommer.models.spool.DEFAULT_SEGMENT_SIZE,
+    # When to fsync the spool: "always", "segment" or "never".
+    "datanommer.spool.fsync": "segment",
+    # Spool the following messages when storing messages takes longer than
+    # this many seconds. The default of 0 only spools on errors.
+    "datanommer.spool.latency_threshold": 0,
+    # Number of seconds between attempts to store the spooled messages.
+    "datanommer.spool.replay_interval": 10.0,
 }
 
 
 log = logging.getLogger("fedmsg")
 
 
+def _init_worker(config, codec):
+    # Process workers are spawned, so they set up what prepare() needs.
+    fedmsg.meta.make_processors(**config)
+    datanommer.models.set_codec(codec)
+
+
 class Nommer(fedmsg.consumers.FedmsgConsumer):
     topic = "*"
     config_key = "datanommer.enabled"
@@ -52,12 +101,310 @@ class Nommer(fedmsg.consumers.FedmsgConsumer):
             return
 
         # Setup a sqlalchemy DB connection (postgres, or sqlite)
-        datanommer.models.init(self.hub.config["datanommer.sqlalchemy.url"])
+        datanommer.models.init(
+            self.hub.config["datanommer.sqlalchemy.url"],
+            cache_size=int(self._get_config("datanommer.cache.size")),
+            cache_preload=int(self._get_config("datanommer.cache.preload")),
+            codec=self._get_config("datanommer.codec"),
+        )
+
+        self.batch_size = int(self._get_config("datanommer.batch.size"))
+        self.batch_max_delay = float(self._get_config("datanommer.batch.max_delay"))
+        self._batch = []
+        self._batch_started = None
+        self._batch_lock = threading.Lock()
+        self._batch_timer = None
+
+        self._spool = None
+        self._spooling = False
+        self._spool_timer = None
+        self.spool_latency_threshold = float(
+            self._get_config("datanommer.spool.latency_threshold")
+        )
+        if self._get_config("datanommer.spool.path"):
+            self._spool = datanommer.models.spool.Spool(
+                self._get_config("datanommer.spool.path"),
+                segment_size=int(self._get_config("datanommer.spool.segment_size")),
+                fsync=self._get_config("datanommer.spool.fsync"),
+            )
+            self._replay_lock = threading.Lock()
+            self._spool_timer = LoopingCall(
+                moksha.hub.reactor.reactor.callInThread, self.replay_spool
+            )
+            self._spool_timer.start(
+                float(self._get_config("datanommer.spool.replay_interval")),
+                now=False,
+            )
+
+        self._pipeline = None
+        workers = int(self._get_config("datanommer.pipeline.workers"))
+        if workers > 0:
+            # Messages are prepared by a pool of workers, and their futures are
+            # queued in order for a single writer thread.  Process workers are
+            # spawned rather than forked, as forking would copy the hub's
+            # threads' locks and database connections in an unknown state.
+            if self._get_config("datanommer.pipeline.executor") == "process":
+                if sys.version_info < (3, 7):
+                    raise ValueError(
+                        "The process executor requires Python 3.7 or later"
+                    )
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(
+                        dict(self.hub.config),
+                        self._get_config("datanommer.codec"),
+                    ),
+                )
+            else:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=workers
+                )
+            self._pipeline = queue.Queue(
+                maxsize=int(self._get_config("datanommer.pipeline.queue_size"))
+            )
+            self._writer = threading.Thread(
+                target=self._write_loop, name="datanommer-writer", daemon=True
+            )
+            self._writer.start()
+        elif self.batch_size > 1:
+            # Commit the pending messages when the bus is quiet. The check runs
+            # in the reactor's thread pool to avoid blocking the reactor.
+            self._batch_timer = LoopingCall(
+                moksha.hub.reactor.reactor.callInThread, self.flush_if_stale
+            )
+            self._batch_timer.start(self.batch_max_delay, now=False)
+
+    def _get_config(self, key):
+        return self.hub.config.get(key, DEFAULTS[key])
+
+    def __json__(self):
+        results = super().__json__()
+        if self._initialized:
+            results["datanommer"] = dict(datanommer.models.stats)
+            results["datanommer"]["spooling"] = self._spooling
+            for name, cache in (
+                ("users", datanommer.models._users_seen),
+                ("packages", datanommer.models._packages_seen),
+                ("topics", datanommer.models._processors),
+            ):
+                results["datanommer"][f"{name}_cache_size"] = len(cache)
+                results["datanommer"][f"{name}_cache_hits"] = cache.hits
+                results["datanommer"][f"{name}_cache_misses"] = cache.misses
+        return results
 
     def consume(self, message):
         log.debug("Nomming %r" % message)
+        if self._spooling:
+            self._spool_messages([message])
+            return
+
+        if self._pipeline is not None:
+            # This blocks when the writer falls behind, which applies
+            # backpressure on the hub.
+            try:
+                future = self._executor.submit(datanommer.models.prepare, message)
+            except Exception as e:
+                # The pool is broken, the writer stores the message itself.
+                future = concurrent.futures.Future()
+                future.set_exception(e)
+            self._pipeline.put((message, future))
+            return
+
+        if self.batch_size <= 1:
+            started = time.monotonic()
+            try:
+                datanommer.models.add(message)
+            except Exception as e:
+                datanommer.models.session.rollback()
+                if not self._can_spool(e):
+                    raise
+                self._spool_messages([message])
+                return
+            self._check_latency(started)
+            return
+
+        with self._batch_lock:
+            if not self._batch:
+                self._batch_started = time.monotonic()
+            self._batch.append(message)
+            if len(self._batch) >= self.batch_size or self._batch_is_stale():
+                self._flush_batch()
+
+    def flush(self):
+        """Commit the messages waiting in the current batch."""
+        with self._batch_lock:
+            self._flush_batch()
+
+    def flush_if_stale(self):
+        """Commit the current batch if it has waited longer than allowed."""
+        with self._batch_lock:
+            if self._batch_is_stale():
+                self._flush_batch()
+
+    def stop(self):
+        if getattr(self, "_initialized", False):
+            if self._batch_timer is not None and self._batch_timer.running:
+                self._batch_timer.stop()
+            if self._spool_timer is not None and self._spool_timer.running:
+                self._spool_timer.stop()
+            self.flush()
+            if self._pipeline is not None:
+                # Let the writer store the messages that are still queued.
+                self._pipeline.put(StopIteration)
+                self._writer.join()
+                self._executor.shutdown()
+            if self._spool is not None:
+                self._spool.close()
+        super().stop()
+
+    def _batch_is_stale(self):
+        if not self._batch:
+            return False
+        return time.monotonic() - self._batch_started >= self.batch_max_delay
+
+    def _flush_batch(self):
+        # Must be called with the batch lock held.
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+        log.debug("Committing a batch of %d messages" % len(batch))
+        self._store(batch, datanommer.models.add_many, datanommer.models.add)
+
+    def _write_loop(self):
+        stopping = False
+        while not stopping:
+            # Wait for a message, then group it with the messages that are
+            # already prepared, up to the batch size.
+            items = []
+            item = self._pipeline.get()
+            while item is not StopIteration:
+                items.append(item)
+                if len(items) >= self.batch_size:
+                    break
+                try:
+                    item = self._pipeline.get_nowait()
+                except queue.Empty:
+                    break
+            else:
+                stopping = True
+            if items:
+                try:
+                    self._write(items)
+                except Exception:
+                    # Keep the writer alive, or the queue would fill up and
+                    # block the hub.
+                    datanommer.models.session.rollback()
+                    log.exception(
+                        "Could not write %d messages, retrying them one by one",
+                        len(items),
+                    )
+                    envelopes = [message for message, future in items]
+                    self._store_each(envelopes, datanommer.models.add, envelopes)
+        datanommer.models.session.remove()
+
+    def _write(self, items):
+        messages, prepared, unprepared = [], [], []
+        for message, future in items:
+            try:
+                prepared.append(future.result())
+            except Exception:
+                # The worker may have died, store the message without it.
+                log.warning("Could not prepare a message for storage", exc_info=True)
+                unprepared.append(message)
+            else:
+                messages.append(message)
+        if self._spooling:
+            self._spool_messages(messages + unprepared)
+            return
+        if prepared:
+            self._store(
+                prepared,
+                datanommer.models.add_prepared,
+                lambda prepared_message: datanommer.models.add_prepared(
+                    [prepared_message]
+                ),
+                envelopes=messages,
+            )
+        if unprepared:
+            if self._spooling:
+                self._spool_messages(unprepared)
+                return
+            self._store(unprepared, datanommer.models.add_many, datanommer.models.add)
+
+    def _store(self, messages, add_many, add, envelopes=None):
+        # When the database is unavailable, the messages are spooled.
+        if envelopes is None:
+            envelopes = messages
+        started = time.monotonic()
         try:
-            datanommer.models.add(message)
-        except Exception:
+            add_many(messages)
+        except Exception as e:
             datanommer.models.session.rollback()
-            raise
+            if self._can_spool(e):
+                self._spool_messages(envelopes)
+                return
+            log.exception(
+                "Could not store a batch of %d messages, retrying them one by one",
+                len(messages),
+            )
+            self._store_each(messages, add, envelopes)
+        else:
+            self._check_latency(started)
+
+    def _store_each(self, messages, add, envelopes):
+        for index, message in enumerate(messages):
+            try:
+                add(message)
+            except Exception as e:
+                datanommer.models.session.rollback()
+                if self._can_spool(e):
+                    self._spool_messages(envelopes[index:])
+                    return
+                log.exception("Could not store message %r", message)
+
+    def replay_spool(self):
+        """Store the spooled messages in the database, if it is available.
+
+        Messages are stored directly again once the spool is empty.
+        """
+        with self._replay_lock:
+            try:
+                count = self._spool.replay(
+                    datanommer.models.spool.store,
+                    batch_size=max(self.batch_size, 100),
+                )
+            except Exception:
+                log.warning("The database is still unavailable", exc_info=True)
+                return
+            finally:
+                datanommer.models.session.remove()
+            datanommer.models.stats["replayed_messages"] += count
+            if self._spooling and self._spool.is_empty():
+                log.info("The spool is empty, storing messages directly again")
+                self._spooling = False
+
+    def _can_spool(self, error):
+        return self._spool is not None and isinstance(
+            error, datanommer.models.spool.UNAVAILABLE_ERRORS
+        )
+
+    def _check_latency(self, started):
+        if self._spool is None or not self.spool_latency_threshold or self._spooling:
+            return
+        if time.monotonic() - started > self.spool_latency_threshold:
+            log.warning(
+                "The database took more than %s seconds to store messages, "
+                "spooling the following ones",
+                self.spool_latency_threshold,
+            )
+            self._spooling = True
+
+    def _spool_messages(self, envelopes):
+        if not self._spooling:
+            log.warning("The database is unavailable, spooling messages")
+            self._spooling = True
+        for envelope in envelopes:
+            self._spool.append(envelope)
+        datanommer.models.stats["spooled_messages"] += len(envelopes)
@@ -16,4 +16,25 @@
 config = {
     "datanommer.enabled": True,
     "datanommer.sqlalchemy.url": "sqlite:///datanommer.db",
+    # Serialize messages with orjson, which must be installed.
+    # "datanommer.codec": "orjson",
+    # Commit messages in groups of up to 100, waiting at most 1 second.
+    # "datanommer.batch.size": 100,
+    # "datanommer.batch.max_delay": 1.0,
+    # Remember up to 50000 users and packages, starting with the ones seen in
+    # the last 100000 messages.
+    # "datanommer.cache.size": 50000,
+    # "datanommer.cache.preload": 100000,
+    # Prepare messages in 4 processes while a separate thread writes them.
+    # "datanommer.pipeline.workers": 4,
+    # "datanommer.pipeline.executor": "process",
+    # "datanommer.pipeline.queue_size": 1000,
+    # Spool messages on disk while the database is unavailable, or when storing
+    # messages takes more than 5 seconds, and try to store them every 10
+    # seconds. See the datanommer-spool command.
+    # "datanommer.spool.path": "/var/spool/datanommer",
+    # "datanommer.spool.segment_size": 64 * 1024 * 1024,
+    # "datanommer.spool.fsync": "segment",
+    # "datanommer.spool.latency_threshold": 5,
+    # "datanommer.spool.replay_interval": 10.0,
 }
@@ -14,9 +14,13 @@
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 import copy
+import os
+import shutil
+import tempfile
 import unittest
 from unittest import mock
 
+import sqlalchemy.exc
 from sqlalchemy.orm import scoped_session
 
 import datanommer.consumer
@@ -26,7 +30,9 @@ import datanommer.models
 filename = ":memory:"
 
 
-class TestConsumer(unittest.TestCase):
+class ConsumerTests:
+    """The setup and the tests shared by all the ways of storing messages."""
+
     @classmethod
     def setUpClass(cls):
         import fedmsg.config
@@ -46,6 +52,11 @@ class TestConsumer(unittest.TestCase):
             def subscribe(*args, **kwargs):
                 pass
 
+            def close(*args, **kwargs):
+                pass
+
+        self.FakeHub = FakeHub
+
         # We only have to do this so that we can do it over
         # and over again for each test.
         datanommer.models.session = scoped_session(datanommer.models.maker)
@@ -60,8 +71,9 @@ class TestConsumer(unittest.TestCase):
         datanommer.models.session.rollback()
         engine = datanommer.models.session.get_bind()
         datanommer.models.DeclarativeBase.metadata.drop_all(engine)
-        datanommer.models._users_seen = set()
-        datanommer.models._packages_seen = set()
+        datanommer.models._users_seen.clear()
+        datanommer.models._packages_seen.clear()
+        datanommer.models.stats.clear()
 
     def test_duplicate_msg_id(self):
         example_message = dict(
@@ -89,3 +101,290 @@ class TestConsumer(unittest.TestCase):
             assert datanommer.models.Message.query.count() == 1
 
         mocked_function.assert_not_called()
+
+    def test_json_stats(self):
+        self.consumer.consume(self._make_message("1"))
+        self.consumer.consume(self._make_message("1"))
+        stats = self.consumer.__json__()["datanommer"]
+        assert stats["duplicate_messages"] == 1
+        assert stats["users_cache_size"] == 0
+        assert stats["packages_cache_misses"] == 0
+
+    def _make_batching_consumer(self, size=3, max_delay=60):
+        hub = self.FakeHub()
+        hub.config = dict(self.fedmsg_config)
+        hub.config["datanommer.batch.size"] = size
+        hub.config["datanommer.batch.max_delay"] = max_delay
+        consumer = datanommer.consumer.Nommer(hub)
+        self.addCleanup(consumer.stop)
+        return consumer
+
+    def _make_message(self, msg_id):
+        return dict(
+            topic="topic.lol.lol.lol",
+            body=dict(
+                topic="topic.lol.lol.lol",
+                i=1,
+                msg_id=msg_id,
+                timestamp=1234,
+                msg=dict(foo="bar"),
+            ),
+        )
+
+    def _make_spooling_consumer(self, **config):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        hub = self.FakeHub()
+        hub.config = dict(self.fedmsg_config)
+        hub.config["datanommer.spool.path"] = path
+        for key, value in config.items():
+            hub.config["datanommer." + key] = value
+        consumer = datanommer.consumer.Nommer(hub)
+        self.addCleanup(consumer.stop)
+        return consumer
+
+
+class TestConsumer(ConsumerTests, unittest.TestCase):
+    """Messages stored by the hub's worker threads, alone or in batches."""
+
+    def test_batch_commit_when_full(self):
+        consumer = self._make_batching_consumer(size=3)
+        consumer.consume(self._make_message("1"))
+        consumer.consume(self._make_message("2"))
+        assert datanommer.models.Message.query.count() == 0
+        consumer.consume(self._make_message("3"))
+        assert datanommer.models.Message.query.count() == 3
+
+    def test_batch_duplicate_msg_id(self):
+        consumer = self._make_batching_consumer(size=3)
+        consumer.consume(self._make_message("1"))
+        consumer.consume(self._make_message("1"))
+        consumer.consume(self._make_message("2"))
+        assert datanommer.models.Message.query.count() == 2
+
+    def test_batch_max_delay(self):
+        consumer = self._make_batching_consumer(size=3, max_delay=10)
+        with mock.patch("datanommer.consumer.time.monotonic") as monotonic:
+            monotonic.return_value = 100
+            consumer.consume(self._make_message("1"))
+            consumer.flush_if_stale()
+            assert datanommer.models.Message.query.count() == 0
+            monotonic.return_value = 111
+            consumer.flush_if_stale()
+        assert datanommer.models.Message.query.count() == 1
+
+    def test_batch_flush_on_stop(self):
+        consumer = self._make_batching_consumer(size=3)
+        consumer.consume(self._make_message("1"))
+        assert datanommer.models.Message.query.count() == 0
+        consumer.stop()
+        assert datanommer.models.Message.query.count() == 1
+
+    def test_batch_failure(self):
+        consumer = self._make_batching_consumer(size=3)
+        add, add_many = datanommer.models.add, datanommer.models.add_many
+
+        def check(envelope):
+            if envelope["body"]["msg_id"] == "2":
+                raise ValueError("This message is broken")
+
+        def failing_add(envelope, commit=True):
+            check(envelope)
+            return add(envelope, commit=commit)
+
+        def failing_add_many(envelopes, commit=True):
+            for envelope in envelopes:
+                check(envelope)
+            return add_many(envelopes, commit=commit)
+
+        with mock.patch("datanommer.models.add", side_effect=failing_add):
+            with mock.patch("datanommer.models.add_many", side_effect=failing_add_many):
+                consumer.consume(self._make_message("1"))
+                consumer.consume(self._make_message("2"))
+                consumer.consume(self._make_message("3"))
+
+        # The broken message does not prevent the others from being stored.
+        assert datanommer.models.Message.query.count() == 2
+
+    def test_spool_database_unavailable(self):
+        consumer = self._make_spooling_consumer()
+        error = sqlalchemy.exc.OperationalError("INSERT", {}, Exception("down"))
+        with mock.patch("datanommer.models.add", side_effect=error) as add:
+            consumer.consume(self._make_message("1"))
+            consumer.consume(self._make_message("2"))
+            # Once the database is unavailable, messages go straight to the spool.
+            assert add.call_count == 1
+            with mock.patch("datanommer.models.add_many", side_effect=error):
+                consumer.replay_spool()
+        assert consumer._spooling
+        assert datanommer.models.Message.query.count() == 0
+
+        consumer.replay_spool()
+        assert not consumer._spooling
+        assert datanommer.models.Message.query.count() == 2
+        stats = consumer.__json__()["datanommer"]
+        assert stats["spooled_messages"] == 2
+        assert stats["replayed_messages"] == 2
+
+        consumer.consume(self._make_message("3"))
+        assert datanommer.models.Message.query.count() == 3
+
+    def test_spool_other_errors(self):
+        consumer = self._make_spooling_consumer()
+        with mock.patch("datanommer.models.add", side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                consumer.consume(self._make_message("1"))
+        assert not consumer._spooling
+
+    def test_spool_batch_database_unavailable(self):
+        consumer = self._make_spooling_consumer(**{"batch.size": 2})
+        error = sqlalchemy.exc.OperationalError("INSERT", {}, Exception("down"))
+        with mock.patch("datanommer.models.add_many", side_effect=error):
+            consumer.consume(self._make_message("1"))
+            consumer.consume(self._make_message("2"))
+        assert consumer._spooling
+        consumer.stop()
+        assert datanommer.models.Message.query.count() == 0
+        (segment,) = datanommer.models.spool.segments(consumer._spool.path)
+        assert len(list(datanommer.models.spool.read(segment))) == 2
+
+    def test_spool_latency(self):
+        consumer = self._make_spooling_consumer(**{"spool.latency_threshold": 5})
+        with mock.patch("datanommer.consumer.time.monotonic") as monotonic:
+            monotonic.side_effect = [100, 110]
+            consumer.consume(self._make_message("1"))
+        # The slow write succeeded, but the next messages are spooled.
+        assert consumer._spooling
+        consumer.consume(self._make_message("2"))
+        assert datanommer.models.Message.query.count() == 1
+        consumer.replay_spool()
+        assert datanommer.models.Message.query.count() == 2
+
+
+class TestPipeline(ConsumerTests, unittest.TestCase):
+    """Run the shared consumer tests again, with messages stored by a writer
+    thread.
+
+    The writer thread has its own connection, so the database can't be in
+    memory.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.fedmsg_config = dict(cls.fedmsg_config)
+        cls.fedmsg_config["datanommer.pipeline.workers"] = 2
+
+    def setUp(self):
+        fd, self.db_path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.fedmsg_config["datanommer.sqlalchemy.url"] = "sqlite:///%s" % self.db_path
+        super().setUp()
+        self.addCleanup(self.consumer.stop)
+
+    def tearDown(self):
+        super().tearDown()
+        os.unlink(self.db_path)
+
+    def consume(self, consumer, *messages):
+        for message in messages:
+            consumer.consume(message)
+        # Wait for the writer to store everything.
+        consumer.stop()
+        datanommer.models.session.commit()
+
+    def test_duplicate_msg_id(self):
+        self.consume(
+            self.consumer, self._make_message("1234"), self._make_message("1234")
+        )
+        assert datanommer.models.Message.query.count() == 1
+
+    def test_json_stats(self):
+        self.consume(self.consumer, self._make_message("1"), self._make_message("1"))
+        stats = self.consumer.__json__()["datanommer"]
+        assert stats["duplicate_messages"] == 1
+
+    def test_pipeline_order(self):
+        messages = [self._make_message(str(i)) for i in range(20)]
+        self.consume(self.consumer, *messages)
+        stored = datanommer.models.Message.query.order_by(datanommer.models.Message.id)
+        assert [m.msg_id for m in stored] == [str(i) for i in range(20)]
+
+    def test_pipeline_batch(self):
+        consumer = self._make_batching_consumer(size=5)
+        with mock.patch(
+            "datanommer.models.add_prepared", wraps=datanommer.models.add_prepared
+        ) as add_prepared:
+            self.consume(consumer, *[self._make_message(str(i)) for i in range(5)])
+        assert datanommer.models.Message.query.count() == 5
+        assert sum(len(call.args[0]) for call in add_prepared.call_args_list) == 5
+
+    def test_pipeline_broken_message(self):
+        broken = self._make_message("2")
+        del broken["body"]["msg"]
+        self.consume(
+            self.consumer,
+            self._make_message("1"),
+            broken,
+            self._make_message("3"),
+        )
+        # The broken message does not prevent the others from being stored.
+        assert datanommer.models.Message.query.count() == 2
+
+    def test_pipeline_spool(self):
+        consumer = self._make_spooling_consumer()
+        error = sqlalchemy.exc.OperationalError("INSERT", {}, Exception("down"))
+        with mock.patch("datanommer.models.add_prepared", side_effect=error):
+            self.consume(consumer, self._make_message("1"), self._make_message("2"))
+        assert consumer._spooling
+        assert datanommer.models.Message.query.count() == 0
+        consumer.replay_spool()
+        assert datanommer.models.Message.query.count() == 2
+
+    def test_pipeline_broken_pool(self):
+        with mock.patch.object(
+            self.consumer._executor, "submit", side_effect=RuntimeError("broken")
+        ):
+            self.consume(
+                self.consumer, self._make_message("1"), self._make_message("2")
+            )
+        # The writer stores the messages itself.
+        assert datanommer.models.Message.query.count() == 2
+
+    def test_pipeline_write_error(self):
+        write = self.consumer._write
+        calls = []
+
+        def write_once(items):
+            calls.append(items)
+            if len(calls) == 1:
+                raise RuntimeError("oops")
+            write(items)
+
+        with mock.patch.object(self.consumer, "_write", side_effect=write_once):
+            self.consume(
+                self.consumer, self._make_message("1"), self._make_message("2")
+            )
+        # The writer survived the error, and stored the batch one by one.
+        assert datanommer.models.Message.query.count() == 2
+
+    def test_pipeline_write_error_spool(self):
+        consumer = self._make_spooling_consumer()
+        error = sqlalchemy.exc.OperationalError("INSERT", {}, Exception("down"))
+        with mock.patch.object(consumer, "_write", side_effect=RuntimeError):
+            with mock.patch("datanommer.models.add", side_effect=error):
+                self.consume(consumer, self._make_message("1"), self._make_message("2"))
+        # The messages that could not be stored one by one are spooled.
+        assert consumer._spooling
+        assert datanommer.models.Message.query.count() == 0
+        consumer.replay_spool()
+        assert datanommer.models.Message.query.count() == 2
+
+
+class TestProcessPipeline(TestPipeline):
+    """Run the pipeline tests again, with messages prepared by processes."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.fedmsg_config["datanommer.pipeline.executor"] = "process"
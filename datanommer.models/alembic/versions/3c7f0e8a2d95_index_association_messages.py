@@ -0,0 +1,54 @@
+"""Index the messages of the user and package associations
+
+Revision ID: 3c7f0e8a2d95
+Revises: f5c3a1e9b7d2
+Create Date: 2026-10-18 15:32:08.671204
+
+"""
+
+import logging
+import time
+
+from alembic import context, op
+
+
+# revision identifiers, used by Alembic.
+revision = "3c7f0e8a2d95"
+down_revision = "f5c3a1e9b7d2"
+
+log = logging.getLogger("alembic.migration")
+
+INDEXES = {
+    "ix_user_messages_msg": "user_messages",
+    "ix_package_messages_msg": "package_messages",
+}
+
+
+# SQL commands:
+# CREATE INDEX CONCURRENTLY ix_user_messages_msg ON user_messages (msg);
+# CREATE INDEX CONCURRENTLY ix_package_messages_msg ON package_messages (msg);
+
+
+def upgrade():
+    """Creates indexes on user_messages.msg and package_messages.msg, to find
+    the users and packages of messages: their primary keys start with the
+    name.  They are built concurrently with PostgreSQL.
+    """
+    start = time.time()
+    try:
+        if op.get_bind().dialect.name == "postgresql":
+            # Don't block the consumer while the indexes are built.
+            with context.get_context().autocommit_block():
+                for name, table in INDEXES.items():
+                    op.create_index(name, table, ["msg"], postgresql_concurrently=True)
+        else:
+            for name, table in INDEXES.items():
+                op.create_index(name, table, ["msg"])
+    finally:
+        log.info("Finished in %0.2fs", time.time() - start)
+
+
+def downgrade():
+    """Removes the indexes on user_messages.msg and package_messages.msg."""
+    for name, table in INDEXES.items():
+        op.drop_index(name, table)
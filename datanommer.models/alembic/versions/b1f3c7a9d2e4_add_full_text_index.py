@@ -0,0 +1,56 @@
+"""Add an optional full-text index of the messages
+
+Revision ID: b1f3c7a9d2e4
+Revises: 57be773be52b
+Create Date: 2026-10-17 10:12:31.402815
+
+"""
+
+import logging
+import time
+
+from alembic import context, op
+
+from datanommer.models import search
+
+
+# revision identifiers, used by Alembic.
+revision = "b1f3c7a9d2e4"
+down_revision = "57be773be52b"
+
+log = logging.getLogger("alembic.migration")
+
+
+def upgrade():
+    """Creates the full-text index of the messages, see
+    datanommer.models.search, when requested with:
+
+        alembic -x search_index=true upgrade head
+
+    Indexing slows the inserts down, so it is only done on request.  It can
+    also be done later with datanommer-search-index --create.  The existing
+    messages are indexed afterwards by the datanommer-search-index command.
+    """
+    arguments = context.get_x_argument(as_dictionary=True)
+    if arguments.get("search_index", "").lower() not in ("1", "true", "yes"):
+        log.info("Not creating the full-text index, pass -x search_index=true")
+        return
+    if op.get_bind().dialect.name not in search.DDL:
+        log.info("Full-text search is only supported with PostgreSQL and SQLite")
+        return
+
+    start = time.time()
+    try:
+        search.create(op.get_bind())
+        # Don't block the consumer while the index is built.
+        with context.get_context().autocommit_block():
+            search.create_index(op.get_bind())
+    finally:
+        log.info("Finished in %0.2fs", time.time() - start)
+
+
+def downgrade():
+    """Removes the full-text index of the messages, if it was created."""
+    bind = op.get_bind()
+    if bind.dialect.name in search.DDL and search.exists(bind):
+        search.drop(bind)
@@ -0,0 +1,62 @@
+"""Add an optional trigram index of the messages
+
+Revision ID: c4d8e2f61a0b
+Revises: b1f3c7a9d2e4
+Create Date: 2026-10-17 14:48:05.117294
+
+"""
+
+import logging
+import time
+
+from alembic import context, op
+
+from datanommer.models import search
+
+
+# revision identifiers, used by Alembic.
+revision = "c4d8e2f61a0b"
+down_revision = "b1f3c7a9d2e4"
+
+log = logging.getLogger("alembic.migration")
+
+
+# SQL commands:
+# CREATE EXTENSION IF NOT EXISTS pg_trgm;
+# CREATE INDEX CONCURRENTLY messages_msg_trgm ON messages
+#     USING gin (_msg gin_trgm_ops);
+
+
+def upgrade():
+    """Creates a pg_trgm index on messages._msg, which serves the LIKE
+    patterns of Message.grep(contains=...), when requested with:
+
+        alembic -x trigram_index=true upgrade head
+
+    The index is about as large as the messages and slows inserts down, so it
+    is only created on request, and only with PostgreSQL.  Once this revision
+    is applied, it can still be created with:
+
+        datanommer-search-index --trigram
+    """
+    arguments = context.get_x_argument(as_dictionary=True)
+    if arguments.get("trigram_index", "").lower() not in ("1", "true", "yes"):
+        log.info("Not creating the trigram index, pass -x trigram_index=true")
+        return
+    if op.get_bind().dialect.name != "postgresql":
+        log.info("Trigram indexes are only supported with PostgreSQL")
+        return
+
+    start = time.time()
+    try:
+        # Building the index takes a while, don't block the consumer meanwhile.
+        with context.get_context().autocommit_block():
+            search.create_trigram_index(op.get_bind())
+    finally:
+        log.info("Finished in %0.2fs", time.time() - start)
+
+
+def downgrade():
+    """Removes the trigram index on messages._msg, if it was created."""
+    if op.get_bind().dialect.name == "postgresql":
+        op.execute("DROP INDEX IF EXISTS messages_msg_trgm")
@@ -0,0 +1,56 @@
+"""Index the JSON of the messages
+
+Revision ID: d9a1f4b7e3c2
+Revises: c4d8e2f61a0b
+Create Date: 2026-10-17 17:20:44.583120
+
+"""
+
+import logging
+import time
+
+from alembic import context, op
+
+from datanommer.models import MSG_JSONB_DDL
+
+
+# revision identifiers, used by Alembic.
+revision = "d9a1f4b7e3c2"
+down_revision = "c4d8e2f61a0b"
+
+log = logging.getLogger("alembic.migration")
+
+
+# SQL commands:
+# CREATE OR REPLACE FUNCTION datanommer_msg_jsonb(msg text) RETURNS jsonb ...;
+# CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_msg_json ON messages
+#     USING gin (datanommer_msg_jsonb(_msg) jsonb_path_ops);
+
+
+def upgrade():
+    """Creates a GIN index on the JSON of messages._msg, which serves the
+    json_filters of Message.grep(), with PostgreSQL only.
+
+    The JSON is parsed by the datanommer_msg_jsonb() function, which returns
+    NULL instead of failing on the JSON that jsonb rejects, like \\u0000, so
+    that neither building the index nor storing such messages fails.
+    """
+    if op.get_bind().dialect.name != "postgresql":
+        return
+
+    start = time.time()
+    try:
+        function, index = MSG_JSONB_DDL
+        op.execute(function)
+        # Building the index takes a while, don't block the consumer meanwhile.
+        with context.get_context().autocommit_block():
+            op.execute(index.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY"))
+    finally:
+        log.info("Finished in %0.2fs", time.time() - start)
+
+
+def downgrade():
+    """Removes the index on the JSON of messages._msg and its function."""
+    if op.get_bind().dialect.name == "postgresql":
+        op.drop_index("messages_msg_json", "messages")
+        op.execute("DROP FUNCTION datanommer_msg_jsonb(text)")
@@ -0,0 +1,60 @@
+"""Add the (category, timestamp) and (topic, timestamp) indexes
+
+Revision ID: e2b6c8d04f17
+Revises: d9a1f4b7e3c2
+Create Date: 2026-10-17 21:05:12.940377
+
+"""
+
+import logging
+import time
+
+from alembic import context, op
+
+
+# revision identifiers, used by Alembic.
+revision = "e2b6c8d04f17"
+down_revision = "d9a1f4b7e3c2"
+
+log = logging.getLogger("alembic.migration")
+
+INDEXES = {
+    "messages_category_timestamp": ["category", "timestamp"],
+    "messages_topic_timestamp": ["topic", "timestamp"],
+}
+
+
+# SQL commands:
+# CREATE INDEX CONCURRENTLY messages_category_timestamp
+#     ON messages (category, timestamp);
+# CREATE INDEX CONCURRENTLY messages_topic_timestamp
+#     ON messages (topic, timestamp);
+
+
+def upgrade():
+    """Creates indexes on messages.category and messages.topic with
+    messages.timestamp, for the queries on the latest messages of a category
+    or a topic.  They are built concurrently with PostgreSQL.
+    """
+    start = time.time()
+    try:
+        if op.get_bind().dialect.name == "postgresql":
+            # Don't block the consumer while the indexes are built.
+            with context.get_context().autocommit_block():
+                for name, columns in INDEXES.items():
+                    op.create_index(
+                        name, "messages", columns, postgresql_concurrently=True
+                    )
+        else:
+            for name, columns in INDEXES.items():
+                op.create_index(name, "messages", columns)
+    finally:
+        log.info("Finished in %0.2fs", time.time() - start)
+
+
+def downgrade():
+    """Removes the indexes on messages.category and messages.topic with
+    messages.timestamp.
+    """
+    for name in INDEXES:
+        op.drop_index(name, "messages")
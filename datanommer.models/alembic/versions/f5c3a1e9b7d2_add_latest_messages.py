@@ -0,0 +1,100 @@
+"""Add the tables of the latest message of each topic and category
+
+Revision ID: f5c3a1e9b7d2
+Revises: e2b6c8d04f17
+Create Date: 2026-10-18 09:41:27.208351
+
+"""
+
+import logging
+import time
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "f5c3a1e9b7d2"
+down_revision = "e2b6c8d04f17"
+
+log = logging.getLogger("alembic.migration")
+
+
+def upgrade():
+    """Creates the latest_messages and latest_category_messages tables, and
+    fills them from the messages with a window query.
+    """
+    start = time.time()
+    try:
+        topic_table = op.create_table(
+            "latest_messages",
+            sa.Column("topic", sa.UnicodeText(), primary_key=True),
+            sa.Column(
+                "msg", sa.Integer(), sa.ForeignKey("messages.id"), nullable=False
+            ),
+            sa.Column("timestamp", sa.DateTime(), nullable=False),
+        )
+        category_table = op.create_table(
+            "latest_category_messages",
+            sa.Column("category", sa.UnicodeText(), primary_key=True),
+            sa.Column(
+                "msg", sa.Integer(), sa.ForeignKey("messages.id"), nullable=False
+            ),
+            sa.Column("timestamp", sa.DateTime(), nullable=False),
+        )
+
+        messages = sa.table(
+            "messages",
+            sa.column("id"),
+            sa.column("topic"),
+            sa.column("category"),
+            sa.column("timestamp"),
+        )
+        first = sa.literal_column("1")
+
+        # The latest message of each topic, in a single pass on the messages.
+        rank = sa.func.row_number().over(
+            partition_by=messages.c.topic,
+            order_by=(messages.c.timestamp.desc(), messages.c.id.desc()),
+        )
+        ranked = sa.select(
+            [messages.c.topic, messages.c.id, messages.c.timestamp, rank.label("rank")]
+        ).subquery()
+        latest = sa.select([ranked.c.topic, ranked.c.id, ranked.c.timestamp])
+        op.execute(
+            topic_table.insert().from_select(
+                ["topic", "msg", "timestamp"], latest.where(ranked.c.rank == first)
+            )
+        )
+
+        # The latest message of a category is the latest of one of its topics.
+        rank = sa.func.row_number().over(
+            partition_by=messages.c.category,
+            order_by=(topic_table.c.timestamp.desc(), topic_table.c.msg.desc()),
+        )
+        ranked = (
+            sa.select(
+                [
+                    messages.c.category,
+                    topic_table.c.msg,
+                    topic_table.c.timestamp,
+                    rank.label("rank"),
+                ]
+            )
+            .select_from(topic_table.join(messages, messages.c.id == topic_table.c.msg))
+            .subquery()
+        )
+        latest = sa.select([ranked.c.category, ranked.c.msg, ranked.c.timestamp])
+        op.execute(
+            category_table.insert().from_select(
+                ["category", "msg", "timestamp"], latest.where(ranked.c.rank == first)
+            )
+        )
+    finally:
+        log.info("Finished in %0.2fs", time.time() - start)
+
+
+def downgrade():
+    """Removes the latest_messages and latest_category_messages tables."""
+    op.drop_table("latest_category_messages")
+    op.drop_table("latest_messages")
@@ -13,31 +13,46 @@
 #
 # You should have received a copy of the GNU General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
+import base64
+import binascii
+import collections
 import datetime
+import functools
+import json
 import logging
 import math
+import threading
 import traceback
 import uuid
 
 import fedmsg.encoding
+import fedmsg.meta
 import pkg_resources
 from sqlalchemy import (
+    and_,
     between,
     Column,
     create_engine,
     DateTime,
+    DDL,
     event,
+    exists,
     ForeignKey,
+    func,
+    Index,
     Integer,
     not_,
     or_,
+    select,
     UnicodeText,
 )
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import (
     backref,
+    load_only,
     relationship,
     scoped_session,
     sessionmaker,
@@ -46,6 +61,11 @@ from sqlalchemy.orm import (
 from sqlalchemy.schema import Table
 
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 maker = sessionmaker()
 session = scoped_session(maker)
 
@@ -55,11 +75,210 @@ DeclarativeBase.query = session.query_property()
 
 log = logging.getLogger("datanommer")
 
-_users_seen, _packages_seen = set(), set()
+# Default number of users and packages remembered as existing in the db.
+DEFAULT_CACHE_SIZE = 50000
+
+
+class NameCache:
+    """A bounded set of names, which forgets the least recently used ones
+    when it is full.
+
+    This is used to remember which users and packages exist in the db without
+    querying it.  The ``hits`` and ``misses`` attributes count the lookups
+    done with :meth:`missing`.
+    """
+
+    def __init__(self, capacity=DEFAULT_CACHE_SIZE):
+        self.capacity = capacity
+        self.hits = self.misses = 0
+        self._names = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def __len__(self):
+        return len(self._names)
+
+    def missing(self, names):
+        """Return the set of names that are not in the cache."""
+        missing = set()
+        with self._lock:
+            for name in set(names):
+                if name in self._names:
+                    self._names.move_to_end(name)
+                    self.hits += 1
+                else:
+                    missing.add(name)
+                    self.misses += 1
+        return missing
+
+    def update(self, names):
+        """Add names to the cache, evicting the oldest ones if needed."""
+        with self._lock:
+            for name in names:
+                self._names[name] = None
+                self._names.move_to_end(name)
+            while len(self._names) > self.capacity:
+                self._names.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._names.clear()
+            self.hits = self.misses = 0
+
+
+_users_seen, _packages_seen = NameCache(), NameCache()
+
+# Number of topics whose fedmsg.meta processor and category are remembered.
+TOPIC_CACHE_SIZE = 10000
+
+
+class ProcessorCache:
+    """Remember which fedmsg.meta processor handles each topic.
+
+    fedmsg.meta finds the processor of a message by matching its topic against
+    every processor in turn, on every call.  The result only depends on the
+    topic, so it is looked up once per topic and reused for the following
+    messages.  The cache is emptied when the list of processors is replaced or
+    modified, for instance by :func:`fedmsg.meta.make_processors`.
+    """
+
+    def __init__(self, capacity=TOPIC_CACHE_SIZE):
+        self.capacity = capacity
+        self.hits = self.misses = 0
+        self._processors = self._processors_count = None
+        self._by_topic = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._by_topic)
+
+    def get(self, message):
+        """Return the processor of a message, like fedmsg.meta.msg2processor."""
+        processors = fedmsg.meta.processors
+        topic = message["topic"]
+        with self._lock:
+            if (
+                processors is not self._processors
+                or len(processors) != self._processors_count
+            ):
+                self._by_topic.clear()
+                self._processors = processors
+                self._processors_count = len(processors)
+            processor = self._by_topic.get(topic)
+            if processor is not None:
+                self._by_topic.move_to_end(topic)
+                self.hits += 1
+                return processor
+            self.misses += 1
+
+        processor = fedmsg.meta.msg2processor(message)
+        with self._lock:
+            if processors is self._processors:
+                self._by_topic[topic] = processor
+                if len(self._by_topic) > self.capacity:
+                    self._by_topic.popitem(last=False)
+        return processor
+
+    def clear(self):
+        with self._lock:
+            self._by_topic.clear()
+            self.hits = self.misses = 0
+
+
+_processors = ProcessorCache()
+
+# Default maximum number of messages counted by Message.grep(count="capped").
+DEFAULT_COUNT_CAP = 10000
+
+# Default number of messages fetched at a time by Message.grep_iter().
+DEFAULT_CHUNK_SIZE = 1000
+
+# Counters of noteworthy events during ingestion, for monitoring.
+stats = collections.Counter()
+
+
+# Codecs for the msg and headers columns, as (dumps, loads) pairs.  They all
+# store JSON, so the rows written with one codec can be read with any other,
+# including the NaN, Infinity and lone surrogates that the json module allows.
+# The orjson codec writes NaN and infinities as null, though.
+Codec = collections.namedtuple("Codec", ["dumps", "loads"])
+
+CODECS = {
+    # Sorted keys, what datanommer always stored.
+    "fedmsg": Codec(fedmsg.encoding.dumps, fedmsg.encoding.loads),
+    # Keys in insertion order, which spares sorting them.
+    "json": Codec(
+        fedmsg.encoding.FedMsgEncoder(
+            separators=(",", ":"), check_circular=False
+        ).encode,
+        json.loads,
+    ),
+}
+
+
+if orjson is not None:
+
+    def _orjson_dumps(obj):
+        try:
+            text = orjson.dumps(
+                obj,
+                default=fedmsg.encoding.encoder.default,
+                option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME,
+            )
+        except orjson.JSONEncodeError:
+            # For instance integers that don't fit in 64 bits, or lone
+            # surrogates.
+            return CODECS["json"].dumps(obj)
+        # NaN and infinities are written as null, like JSON.stringify() does:
+        # finding them would cost more than the serialization itself.
+        return text.decode("utf-8")
+
+    def _orjson_loads(text):
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            # NaN, Infinity or lone surrogates, which orjson rejects.
+            return json.loads(text)
+
+    # Much faster, but non-ASCII characters are not escaped, and NaN and
+    # infinities become null.
+    CODECS["orjson"] = Codec(_orjson_dumps, _orjson_loads)
 
 
-def init(uri=None, alembic_ini=None, engine=None, create=False):
-    """Initialize a connection.  Create tables if requested."""
+_codec = CODECS["fedmsg"]
+
+
+def set_codec(name):
+    """Use the codec called ``name`` in :data:`CODECS` to serialize messages."""
+    global _codec
+    try:
+        _codec = CODECS[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown codec {name!r}, the available ones are: {', '.join(CODECS)}"
+        )
+
+
+def init(
+    uri=None,
+    alembic_ini=None,
+    engine=None,
+    create=False,
+    cache_size=DEFAULT_CACHE_SIZE,
+    cache_preload=0,
+    codec="fedmsg",
+):
+    """Initialize a connection.  Create tables if requested.
+
+    ``cache_size`` is the number of users and packages that are remembered
+    as existing in the db.  If ``cache_preload`` is set, this memory is
+    filled with the users and packages of that many recent messages.
+    ``codec`` is the name of the codec used to serialize messages, see
+    :data:`CODECS`.
+    """
+    global _users_seen, _packages_seen
 
     if uri and engine:
         raise ValueError("uri and engine cannot both be specified")
@@ -91,6 +310,7 @@ def init(uri=None, alembic_ini=None, engine=None, create=False):
     if getattr(session, "_datanommer_initialized", None):
         log.warning("Session already initialized.  Bailing")
         return
+    set_codec(codec)
     session._datanommer_initialized = True
 
     session.configure(bind=engine)
@@ -108,11 +328,41 @@ def init(uri=None, alembic_ini=None, engine=None, create=False):
     if create:
         DeclarativeBase.metadata.create_all(engine)
 
+    _users_seen = NameCache(cache_size)
+    _packages_seen = NameCache(cache_size)
+    if cache_preload:
+        _preload_cache(_users_seen, user_assoc_table.c.username, cache_preload)
+        _preload_cache(_packages_seen, pack_assoc_table.c.package, cache_preload)
 
-def add(envelope):
-    """Take a dict-like fedmsg envelope and store the headers and message
-    in the table.
-    """
+
+def _preload_cache(cache, column, messages):
+    """Fill the cache with the names associated to recent messages."""
+    last_id = session.query(func.max(Message.id)).scalar()
+    if last_id is None:
+        return
+    # Walk the recent messages by their primary key and look their names up
+    # with the index on the msg column of the association table.
+    query = (
+        session.query(column)
+        .select_from(Message)
+        .join(column.table, column.table.c.msg == Message.id)
+        .filter(Message.id > last_id - messages)
+        .order_by(Message.id.desc())
+        .yield_per(1000)
+    )
+    names = {}
+    for (name,) in query:
+        names[name] = None
+        if len(names) >= cache.capacity:
+            break
+    # The most recently used names go last.
+    cache.update(reversed(list(names)))
+    session.commit()
+    log.info("Preloaded %d names from %s", len(cache), column.table.name)
+
+
+def _message_values(envelope):
+    """Extract the column values of a message from a fedmsg envelope."""
     message = envelope["body"]
     timestamp = message.get("timestamp", None)
     try:
@@ -129,7 +379,7 @@ def add(envelope):
         msg_id = headers.get("message-id", None)
     if not msg_id:
         msg_id = str(timestamp.year) + "-" + str(uuid.uuid4())
-    obj = Message(
+    return dict(
         i=message.get("i", 0),
         msg_id=msg_id,
         topic=message["topic"],
@@ -140,21 +390,12 @@ def add(envelope):
         signature=message.get("signature", None),
     )
 
-    obj.msg = message["msg"]
-    obj.headers = headers
-
-    try:
-        session.add(obj)
-        session.flush()
-    except IntegrityError:
-        log.warning(
-            "Skipping message from %s with duplicate id: %s", message["topic"], msg_id
-        )
-        session.rollback()
-        return
 
-    usernames = fedmsg.meta.msg2usernames(message)
-    packages = fedmsg.meta.msg2packages(message)
+def _extract_names(message, msg_id):
+    """Return the usernames and packages that fedmsg.meta finds in a message."""
+    processor = _processors.get(message)
+    usernames = fedmsg.meta.msg2usernames(message, processor=processor)
+    packages = fedmsg.meta.msg2packages(message, processor=processor)
 
     # Do a little sanity checking on fedmsg.meta results
     if None in usernames:
@@ -169,45 +410,334 @@ def add(envelope):
         # And prune out the bad value
         packages = [pkg for pkg in packages if pkg is not None]
 
-    # If we've never seen one of these users before, then:
-    # 1) make sure they exist in the db (create them if necessary)
-    # 2) mark an in memory cache so we can remember that they exist without
-    #    having to hit the db.
-    for username in usernames:
-        if username not in _users_seen:
-            # Create the user in the DB if necessary
-            User.get_or_create(username)
-            # Then just mark an in memory cache noting that we've seen them.
-            _users_seen.add(username)
-
-    for package in packages:
-        if package not in _packages_seen:
-            Package.get_or_create(package)
-            _packages_seen.add(package)
+    return usernames, packages
 
-    session.flush()
 
-    # These two blocks would normally be a simple "obj.users.append(user)" kind
-    # of statement, but here we drop down out of sqlalchemy's ORM and into the
-    # sql abstraction in order to gain a little performance boost.
-    values = [{"username": username, "msg": obj.id} for username in usernames]
-    if values:
-        session.execute(user_assoc_table.insert(), values)
+def add(envelope, commit=True):
+    """Take a dict-like fedmsg envelope and store the headers and message
+    in the table.
+
+    If ``commit`` is False, the message is only flushed to the database and
+    the caller is responsible for committing the transaction.  This lets the
+    caller group several messages in a single transaction.
+
+    Messages whose ``msg_id`` is already stored are skipped and counted in
+    ``stats["duplicate_messages"]``.
+    """
+    add_many([envelope], commit=commit)
+
+
+def _chunks(items, size):
+    for index in range(0, len(items), size):
+        yield items[index : index + size]
+
+
+def _max_bound_parameters():
+    # SQLite limits the number of bound parameters in a single statement.
+    if session.get_bind().dialect.name == "sqlite":
+        return 999
+    return 32767
 
-    values = [{"package": package, "msg": obj.id} for package in packages]
-    if values:
-        session.execute(pack_assoc_table.insert(), values)
 
-    # TODO -- can we avoid committing every time?
+def _max_rows_per_insert(table):
+    return max(1, _max_bound_parameters() // len(table.columns))
+
+
+def _ignores_duplicates():
+    return session.get_bind().dialect.name in ("postgresql", "sqlite")
+
+
+def _insert_ignoring_duplicates(table):
+    """Return an INSERT statement on the table that skips the rows violating a
+    unique constraint instead of failing.
+
+    Only PostgreSQL and SQLite can do that.  With other dialects, this is a
+    plain INSERT, and the existing rows must be left out first, see
+    :func:`_without_existing`.
+    """
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    elif dialect == "sqlite":
+        return sqlite.insert(table).on_conflict_do_nothing()
+    return table.insert()
+
+
+def _insert_many(table, rows):
+    """Insert rows in a single executemany() call, skipping duplicates.
+
+    The rows are passed as parameters rather than embedded in the statement,
+    so that it is only compiled once.
+    """
+    if not _ignores_duplicates():
+        rows = _without_existing(table, rows)
+        if not rows:
+            return
+    session.execute(_insert_ignoring_duplicates(table), rows)
+
+
+def _without_existing(table, rows):
+    """Return the rows whose primary key isn't in the table yet, nor earlier
+    in the rows, for the dialects that can't skip duplicates on insert.
+
+    Unlike ON CONFLICT DO NOTHING, this can still fail when a concurrent
+    transaction inserts the same rows.
+    """
+    key = list(table.primary_key.columns)
+    existing = set()
+    size = max(1, _max_bound_parameters() // len(key))
+    for chunk in _chunks(rows, size):
+        # Each column of the key is filtered on, composite keys are then
+        # checked here, which works without tuple comparisons.
+        query = select(key).where(
+            and_(*(c.in_({row[c.name] for row in chunk}) for c in key))
+        )
+        existing.update(tuple(row) for row in session.execute(query))
+    missing = []
+    for row in rows:
+        values = tuple(row[c.name] for c in key)
+        if values not in existing:
+            existing.add(values)
+            missing.append(row)
+    return missing
+
+
+def _update_latest(connection, messages):
+    """Record the messages as the latest of their topic and of their category
+    in the latest_messages tables, unless more recent ones are recorded.
+
+    ``messages`` are dicts with the id, topic, category and timestamp of the
+    messages.
+    """
+    dialect = connection.dialect.name
+    for table, key in (
+        (latest_topic_table, "topic"),
+        (latest_category_table, "category"),
+    ):
+        latest = {}
+        for message in messages:
+            current = latest.get(message[key])
+            if current is None or (message["timestamp"], message["id"]) > (
+                current["timestamp"],
+                current["msg"],
+            ):
+                latest[message[key]] = {
+                    key: message[key],
+                    "msg": message["id"],
+                    "timestamp": message["timestamp"],
+                }
+        # Sort the rows so that concurrent transactions lock them in the same
+        # order.
+        values = [latest[name] for name in sorted(latest)]
+        if dialect in ("postgresql", "sqlite"):
+            connection.execute(_upsert_latest(table, key, dialect), values)
+            continue
+        for value in values:
+            newer = _newer_than(table, value["timestamp"], value["msg"])
+            update = table.update().where(table.c[key] == value[key]).where(newer)
+            result = connection.execute(update.values(value))
+            if result.rowcount:
+                continue
+            query = select([table.c[key]]).where(table.c[key] == value[key])
+            if connection.execute(query).first() is None:
+                connection.execute(table.insert(), value)
+
+
+def _newer_than(table, timestamp, msg):
+    # Ties on the timestamp go to the last stored message.
+    return or_(
+        table.c.timestamp < timestamp,
+        and_(table.c.timestamp == timestamp, table.c.msg < msg),
+    )
+
+
+def _upsert_latest(table, key, dialect):
+    insert = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}[dialect]
+    statement = insert(table)
+    excluded = statement.excluded
+    return statement.on_conflict_do_update(
+        index_elements=[table.c[key]],
+        set_={"msg": excluded.msg, "timestamp": excluded.timestamp},
+        where=_newer_than(table, excluded.timestamp, excluded.msg),
+    )
+
+
+# A message ready to be stored: the values of its row in the messages table,
+# and its usernames and packages.  If the names were not extracted yet, they
+# are None and the message body is kept to extract them later.
+PreparedMessage = collections.namedtuple(
+    "PreparedMessage", ["row", "usernames", "packages", "message"]
+)
+
+
+def prepare(envelope, extract_names=True):
+    """Compute everything that is needed to store a dict-like fedmsg envelope,
+    without using the db.
+
+    This is the CPU-heavy part of storing a message: it serializes the message
+    and runs the fedmsg.meta processors to find its users and packages.  It can
+    run in another thread or process than the one storing the result with
+    :func:`add_prepared`.
+    """
+    message = envelope["body"]
+    headers = envelope.get("headers", None)
+    row = _message_values(envelope)
+    row["category"] = _category_from_topic(row["topic"])
+    row["_msg"] = _codec.dumps(message["msg"])
+    row["_headers"] = _codec.dumps(headers) if headers else None
+    row["source_name"] = "datanommer"
+    row["source_version"] = _source_version()
+    if not extract_names:
+        return PreparedMessage(row, None, None, message)
+    usernames, packages = _extract_names(message, row["msg_id"])
+    return PreparedMessage(row, usernames, packages, None)
+
+
+def add_many(envelopes, commit=True):
+    """Store a group of dict-like fedmsg envelopes.
+
+    This is equivalent to calling :func:`add` on each envelope, but the
+    messages and their associations to users and packages are written with a
+    few multi-row statements instead of several statements per message, which
+    makes it much faster to replay or backfill large amounts of messages.
+    Messages whose ``msg_id`` is already stored are skipped and counted in
+    ``stats["duplicate_messages"]``.
+
+    Returns the number of messages that were stored.
+    """
+    # Only extract the names of the messages that are actually stored.
+    return add_prepared(
+        (prepare(envelope, extract_names=False) for envelope in envelopes),
+        commit=commit,
+    )
+
+
+def add_prepared(prepared_messages, commit=True):
+    """Store a group of messages returned by :func:`prepare`.
+
+    See :func:`add_many`.
+    """
+    table = Message.__table__
+
+    received = 0
+    rows = {}
+    prepared = {}
+    for prepared_message in prepared_messages:
+        received += 1
+        row = prepared_message.row
+        if row["msg_id"] in rows:
+            continue
+        rows[row["msg_id"]] = row
+        prepared[row["msg_id"]] = prepared_message
+
+    # Insert the messages and get their primary keys back. Duplicates are
+    # skipped by the database instead of aborting the transaction.
+    ids = {}
+    returning = getattr(session.get_bind().dialect, "full_returning", False)
+    for chunk in _chunks(list(rows.values()), _max_rows_per_insert(table)):
+        msg_ids = [row["msg_id"] for row in chunk]
+        if returning:
+            # RETURNING needs a multi-row INSERT statement, but a single row is
+            # passed as parameters so that the compiled statement is reused.
+            statement = _insert_ignoring_duplicates(table).returning(
+                table.c.id, table.c.msg_id
+            )
+            if len(chunk) == 1:
+                result = session.execute(statement, chunk[0])
+            else:
+                result = session.execute(statement.values(chunk))
+            ids.update((msg_id, id_) for id_, msg_id in result)
+            continue
+        if len(chunk) == 1 and _ignores_duplicates():
+            # A single row needs no lookup: the row count tells whether it
+            # was a duplicate.
+            row = chunk[0]
+            result = session.execute(_insert_ignoring_duplicates(table), row)
+            if result.rowcount == 1:
+                ids[row["msg_id"]] = result.inserted_primary_key[0]
+            continue
+        # Without RETURNING, the inserted rows can't be told apart from the
+        # existing ones afterwards, so leave the known duplicates out first.
+        query = select([table.c.msg_id]).where(table.c.msg_id.in_(msg_ids))
+        existing = {msg_id for (msg_id,) in session.execute(query)}
+        chunk = [row for row in chunk if row["msg_id"] not in existing]
+        if not chunk:
+            continue
+        session.execute(_insert_ignoring_duplicates(table), chunk)
+        query = select([table.c.id, table.c.msg_id]).where(
+            table.c.msg_id.in_([row["msg_id"] for row in chunk])
+        )
+        ids.update((msg_id, id_) for id_, msg_id in session.execute(query))
+
+    duplicates = received - len(ids)
+    if duplicates:
+        stats["duplicate_messages"] += duplicates
+        log.debug("Skipped %d messages with a duplicate id", duplicates)
+
+    user_values, package_values = [], []
+    for msg_id, id_ in ids.items():
+        prepared_message = prepared[msg_id]
+        if prepared_message.message is None:
+            usernames = prepared_message.usernames
+            packages = prepared_message.packages
+        else:
+            usernames, packages = _extract_names(prepared_message.message, msg_id)
+        user_values.extend({"username": name, "msg": id_} for name in usernames)
+        package_values.extend({"package": name, "msg": id_} for name in packages)
+
+    # If we've never seen some of these users or packages before, make sure
+    # they exist in the db, and remember it so we don't hit the db next time.
+    # They are only remembered once the transaction is committed.
+    pending_users = session.info.setdefault("datanommer_pending_users", set())
+    usernames = _users_seen.missing(value["username"] for value in user_values)
+    usernames -= pending_users
+    if usernames:
+        User.ensure(usernames)
+        pending_users.update(usernames)
+
+    pending_packages = session.info.setdefault("datanommer_pending_packages", set())
+    packages = _packages_seen.missing(value["package"] for value in package_values)
+    packages -= pending_packages
+    if packages:
+        Package.ensure(packages)
+        pending_packages.update(packages)
+
+    if user_values:
+        _insert_many(user_assoc_table, user_values)
+    if package_values:
+        _insert_many(pack_assoc_table, package_values)
+
+    if ids:
+        latest = [dict(rows[msg_id], id=id_) for msg_id, id_ in ids.items()]
+        _update_latest(session.connection(), latest)
+
     session.flush()
-    session.commit()
+    if commit:
+        session.commit()
+    return len(ids)
 
 
-def source_version_default(context):
+@functools.lru_cache(maxsize=TOPIC_CACHE_SIZE)
+def _category_from_topic(topic):
+    index = 2 if "VirtualTopic" in topic else 3
+    try:
+        return topic.split(".")[index]
+    except Exception:
+        traceback.print_exc()
+        return "Unclassified"
+
+
+@functools.lru_cache(maxsize=None)
+def _source_version():
+    # Looking up the distribution is slow, and its version can't change.
     dist = pkg_resources.get_distribution("datanommer.models")
     return dist.version
 
 
+def source_version_default(context):
+    return _source_version()
+
+
 class BaseMessage:
     id = Column(Integer, primary_key=True)
     msg_id = Column(UnicodeText, nullable=True, unique=True, default=None, index=True)
@@ -224,36 +754,51 @@ class BaseMessage:
     _msg = Column(UnicodeText, nullable=False)
     _headers = Column(UnicodeText)
 
+    # Whether the parsed msg and headers are kept on the instance, so that
+    # they are only parsed once.  Set it to False on the class or an instance
+    # to parse them on every access instead, for instance to save memory when
+    # scanning many messages.  The memoized dicts are shared between accesses.
+    memoize_payloads = True
+
     @validates("topic")
     def get_category(self, key, topic):
-        index = 2 if "VirtualTopic" in topic else 3
-        try:
-            self.category = topic.split(".")[index]
-        except Exception:
-            traceback.print_exc()
-            self.category = "Unclassified"
+        self.category = _category_from_topic(topic)
         return topic
 
+    def _load(self, column):
+        text = getattr(self, column)
+        if not self.memoize_payloads:
+            return _codec.loads(text)
+        # The payload is kept with the text it was parsed from, so that it is
+        # parsed again when the column changes or is reloaded.
+        payloads = self.__dict__.setdefault("_payloads", {})
+        cached = payloads.get(column)
+        if cached is not None and cached[0] is text:
+            return cached[1]
+        payload = _codec.loads(text)
+        payloads[column] = (text, payload)
+        return payload
+
     @hybrid_property
     def msg(self):
-        return fedmsg.encoding.loads(self._msg)
+        return self._load("_msg")
 
     @msg.setter
     def msg(self, dict_like_msg):
-        self._msg = fedmsg.encoding.dumps(dict_like_msg)
+        self._msg = _codec.dumps(dict_like_msg)
 
     @hybrid_property
     def headers(self):
         hdrs = self._headers
         if hdrs:
-            return fedmsg.encoding.loads(hdrs)
+            return self._load("_headers")
         else:
             return {}
 
     @headers.setter
     def headers(self, headers):
         if headers:
-            self._headers = fedmsg.encoding.dumps(headers)
+            self._headers = _codec.dumps(headers)
         else:
             self._headers = None
 
@@ -281,18 +826,49 @@ class BaseMessage:
 user_assoc_table = Table(
     "user_messages",
     DeclarativeBase.metadata,
-    Column("username", UnicodeText, ForeignKey("user.name")),
-    Column("msg", Integer, ForeignKey("messages.id")),
+    Column("username", UnicodeText, ForeignKey("user.name"), primary_key=True),
+    Column("msg", Integer, ForeignKey("messages.id"), primary_key=True, index=True),
 )
 
 pack_assoc_table = Table(
     "package_messages",
     DeclarativeBase.metadata,
-    Column("package", UnicodeText, ForeignKey("package.name")),
-    Column("msg", Integer, ForeignKey("messages.id")),
+    Column("package", UnicodeText, ForeignKey("package.name"), primary_key=True),
+    Column("msg", Integer, ForeignKey("messages.id"), primary_key=True, index=True),
+)
+
+# The latest message of each topic and of each category, kept up to date as
+# messages are stored, so that finding them doesn't search the messages.
+latest_topic_table = Table(
+    "latest_messages",
+    DeclarativeBase.metadata,
+    Column("topic", UnicodeText, primary_key=True),
+    Column("msg", Integer, ForeignKey("messages.id"), nullable=False),
+    Column("timestamp", DateTime, nullable=False),
+)
+
+latest_category_table = Table(
+    "latest_category_messages",
+    DeclarativeBase.metadata,
+    Column("category", UnicodeText, primary_key=True),
+    Column("msg", Integer, ForeignKey("messages.id"), nullable=False),
+    Column("timestamp", DateTime, nullable=False),
 )
 
 
+@event.listens_for(maker, "after_commit")
+def _remember_pending_names(session):
+    _users_seen.update(session.info.pop("datanommer_pending_users", ()))
+    _packages_seen.update(session.info.pop("datanommer_pending_packages", ()))
+
+
+@event.listens_for(maker, "after_rollback")
+def _forget_pending_names(session):
+    # The users and packages created in the transaction were rolled back.
+    session.info.pop("datanommer_pending_users", None)
+    session.info.pop("datanommer_pending_packages", None)
+
+
 class Singleton:
     @classmethod
     def get_or_create(cls, name):
@@ -317,6 +893,16 @@ class Singleton:
             )
             return cls.query.filter_by(name=name).one()
 
+    @classmethod
+    def ensure(cls, names):
+        """
+        Make sure that instances of the class exist for all the specified
+        names, creating the missing ones in bulk.
+        """
+        # Sort the names so that concurrent transactions lock the rows in the
+        # same order.
+        _insert_many(cls.__table__, [{"name": name} for name in sorted(set(names))])
+
 
 class User(DeclarativeBase, Singleton):
     __tablename__ = "user"
@@ -332,6 +918,11 @@ class Package(DeclarativeBase, Singleton):
 
 class Message(DeclarativeBase, BaseMessage):
     __tablename__ = "messages"
+    # Most queries filter on a category or a topic and order by timestamp.
+    __table_args__ = (
+        Index("messages_category_timestamp", "category", "timestamp"),
+        Index("messages_topic_timestamp", "topic", "timestamp"),
+    )
     users = relationship(
         "User", secondary=user_assoc_table, backref=backref("messages")
     )
@@ -357,7 +948,14 @@ class Message(DeclarativeBase, BaseMessage):
         topics=None,
         not_topics=None,
         contains=None,
+        contains_literal=False,
+        search=None,
+        json_filters=None,
+        columns=None,
         defer=False,
+        cursor=None,
+        count=None,
+        count_cap=DEFAULT_COUNT_CAP,
     ):
         """Flexible query interface for messages.
 
@@ -388,8 +986,73 @@ class Message(DeclarativeBase, BaseMessage):
 
         ----
 
+        The `contains` filter matches the messages whose JSON contains any of
+        the strings, which are LIKE patterns where % and _ are wildcards.  With
+        `contains_literal`, the strings are matched as they are instead.  It
+        scans the whole table, unless the PostgreSQL trigram index of the
+        messages was created, which works best with literal strings, as the
+        wildcards split them into smaller pieces to look up.  The `search`
+        filter matches
+        the messages containing any of the phrases, as words, using the
+        full-text index of :mod:`datanommer.models.search`, which must have
+        been created.
+
+        The `json_filters` argument is a dict of dotted paths in the messages
+        and of the values they must have, all of them:
+
+          json_filters = {'update.status': 'stable', 'update.type': 'bugfix'}
+
+        With PostgreSQL, they are served by the GIN index on the JSON of the
+        messages.  Messages whose JSON PostgreSQL can't parse, because it
+        contains \\u0000, NaN or lone surrogates, are not matched there.
+
+        ----
+
+        The `columns` argument is a list of the columns to load, such as:
+
+          columns = ['msg_id', 'topic', 'timestamp']
+
+        The other columns are only loaded when they are accessed, one message
+        at a time, which saves transferring the JSON, headers, certificate and
+        signature of the messages when they aren't needed.  'msg' and
+        'headers' can be used for the '_msg' and '_headers' columns.
+
+        ----
+
         If the `defer` argument evaluates to True, the query won't actually
-        be executed, but a SQLAlchemy query object returned instead.
+        be executed, but a SQLAlchemy query object returned instead:
+
+          total, page, query = Message.grep(defer=True)
+
+        ----
+
+        Pages can be fetched with a cursor instead of a page number, which
+        stays fast however deep the page is.  Pass ``cursor=True`` to get the
+        first page, and the returned cursor to get the following ones:
+
+          total, pages, messages, cursor = Message.grep(cursor=True)
+          total, pages, messages, cursor = Message.grep(cursor=cursor)
+
+        The cursor is None after the last page.  It must be used with the same
+        filters and order.  With `defer`, the query of the page is returned
+        in place of the messages, and the cursor of the following page is
+        None, as it is only known once the messages are fetched:
+
+          total, pages, query, None = Message.grep(cursor=True, defer=True)
+
+        ----
+
+        Counting all the matching messages can be slower than fetching the
+        page, so the `count` argument selects how the total is computed:
+
+          - "exact": count all the messages, the default without `cursor`.
+          - "none": don't count, the total and the number of pages are None.
+            This is the default with `cursor`, so that each page costs the
+            same however many messages match.
+          - "capped": count up to `count_cap` messages, so a total equal to
+            `count_cap` means "at least `count_cap`".
+          - "estimate": use the estimate of the PostgreSQL query planner,
+            or count exactly with other databases.
         """
 
         users = users or []
@@ -401,6 +1064,7 @@ class Message(DeclarativeBase, BaseMessage):
         topics = topics or []
         not_topics = not_topics or []
         contains = contains or []
+        search = search or []
 
         query = Message.query
 
@@ -420,14 +1084,10 @@ class Message(DeclarativeBase, BaseMessage):
 
         # Add the four positive filters as necessary
         if users:
-            query = query.filter(
-                or_(*(Message.users.any(User.name == u) for u in users))
-            )
+            query = query.filter(_associated_with(user_assoc_table.c.username, users))
 
         if packages:
-            query = query.filter(
-                or_(*(Message.packages.any(Package.name == p) for p in packages))
-            )
+            query = query.filter(_associated_with(pack_assoc_table.c.package, packages))
 
         if categories:
             query = query.filter(
@@ -439,18 +1099,32 @@ class Message(DeclarativeBase, BaseMessage):
 
         if contains:
             query = query.filter(
-                or_(*(Message._msg.like("%%%s%%" % contain) for contain in contains))
+                or_(*(_contains(contain, contains_literal) for contain in contains))
+            )
+
+        if search:
+            from datanommer.models import search as full_text
+
+            query = query.filter(full_text.matches(search, session.get_bind().dialect))
+
+        if json_filters:
+            dialect = session.get_bind().dialect
+            query = query.filter(
+                *(
+                    _json_path_equals(path, value, dialect)
+                    for path, value in json_filters.items()
+                )
             )
 
         # And then the four negative filters as necessary
         if not_users:
             query = query.filter(
-                not_(or_(*(Message.users.any(User.name == u) for u in not_users)))
+                _not_associated_with(user_assoc_table.c.username, not_users)
             )
 
         if not_packs:
             query = query.filter(
-                not_(or_(*(Message.packages.any(Package.name == p) for p in not_packs)))
+                _not_associated_with(pack_assoc_table.c.package, not_packs)
             )
 
         if not_cats:
@@ -463,14 +1137,27 @@ class Message(DeclarativeBase, BaseMessage):
                 not_(or_(*(Message.topic == topic for topic in not_topics)))
             )
 
-        # Finally, tag on our pagination arguments
-        total = query.count()
-        query = query.order_by(getattr(Message.timestamp, order)())
+        if columns is not None:
+            query = query.options(load_only(*(_column_name(c) for c in columns)))
 
+        # Finally, tag on our pagination arguments
+        if count is None:
+            count = "exact" if cursor is None else "none"
+        total = _count(query, count, count_cap)
         if rows_per_page is None:
             pages = 1
+        elif total is None:
+            pages = None
         else:
             pages = int(math.ceil(total / float(rows_per_page)))
+
+        if cursor is not None:
+            return cls._grep_page(
+                query, total, pages, rows_per_page, order, cursor, defer
+            )
+
+        query = query.order_by(getattr(Message.timestamp, order)())
+        if rows_per_page is not None:
             query = query.offset(rows_per_page * (page - 1)).limit(rows_per_page)
 
         if defer:
@@ -480,6 +1167,260 @@ class Message(DeclarativeBase, BaseMessage):
             messages = query.all()
             return total, pages, messages
 
+    @classmethod
+    def latest_by_category(cls, categories=None, since=None):
+        """Return the latest message of each of the categories, in their
+        order, or of all the categories by name if ``categories`` is None.
+        Categories without messages, or without messages after the ``since``
+        datetime, are left out.
+        """
+        return cls._latest(latest_category_table.c.category, categories, since)
+
+    @classmethod
+    def latest_by_topic(cls, topics=None, since=None):
+        """Return the latest message of each of the topics, like
+        :meth:`latest_by_category`."""
+        return cls._latest(latest_topic_table.c.topic, topics, since)
+
+    @classmethod
+    def _latest(cls, column, keys, since):
+        table = column.table
+        query = Message.query.join(table, table.c.msg == Message.id)
+        if keys is not None:
+            if not keys:
+                return []
+            query = query.filter(column.in_(keys))
+        if since is not None:
+            query = query.filter(table.c.timestamp > since)
+        messages = query.order_by(column).all()
+        if keys is None:
+            return messages
+        order = {key: index for index, key in enumerate(keys)}
+        return sorted(
+            messages, key=lambda message: order[getattr(message, column.name)]
+        )
+
+    @classmethod
+    def grep_iter(cls, chunk_size=DEFAULT_CHUNK_SIZE, **filters):
+        """Yield all the messages matching the filters of :meth:`grep`.
+
+        Unlike ``grep(rows_per_page=None)``, the messages are fetched
+        ``chunk_size`` at a time (with a server-side cursor on PostgreSQL),
+        and each one is expunged from the session when the next one is
+        requested, so that the memory used doesn't grow with the number of
+        messages.  Their users and packages can't be loaded after that.
+        """
+        total, page, query = cls.grep(
+            rows_per_page=None, count="none", defer=True, **filters
+        )
+        for message in query.yield_per(chunk_size):
+            yield message
+            session.expunge(message)
+
+    @classmethod
+    def _grep_page(cls, query, total, pages, rows_per_page, order, cursor, defer):
+        # Seek to the page with a range on (timestamp, id), which are also used
+        # to order the messages so that ties on the timestamp are stable.
+        if cursor is not True:
+            timestamp, id_ = _decode_cursor(cursor)
+            if order == "asc":
+                after = or_(Message.timestamp > timestamp, Message.id > id_)
+                query = query.filter(Message.timestamp >= timestamp, after)
+            else:
+                before = or_(Message.timestamp < timestamp, Message.id < id_)
+                query = query.filter(Message.timestamp <= timestamp, before)
+        query = query.order_by(
+            getattr(Message.timestamp, order)(), getattr(Message.id, order)()
+        )
+
+        if defer:
+            if rows_per_page is not None:
+                query = query.limit(rows_per_page)
+            return total, pages, query, None
+
+        if rows_per_page is None:
+            return total, pages, query.all(), None
+        # Fetch one more message to know whether there is a next page.
+        messages = query.limit(rows_per_page + 1).all()
+        if len(messages) <= rows_per_page:
+            return total, pages, messages, None
+        messages = messages[:rows_per_page]
+        return total, pages, messages, _encode_cursor(messages[-1])
+
+
+def _column_name(name):
+    name = {"msg": "_msg", "headers": "_headers"}.get(name, name)
+    if name not in Message.__table__.c:
+        raise ValueError(f"Unknown column: {name!r}")
+    return name
+
+
+def _contains(string, literal=False):
+    """Return a filter on the messages whose JSON contains the string.
+
+    If literal is true, the LIKE wildcards in the string are escaped: besides
+    matching the string as it is, the whole string can then be looked up in
+    the trigram index of the messages that PostgreSQL databases may have.
+    """
+    if not literal:
+        return Message._msg.like(f"%{string}%")
+    escaped = string.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return Message._msg.like(f"%{escaped}%", escape="\\")
+
+
+# With PostgreSQL, the JSON of the messages is parsed as jsonb by this
+# function, which is indexed.  jsonb rejects some of the JSON that the codecs
+# write: \u0000, NaN, infinities and lone surrogates.  The function returns
+# NULL for them instead of failing, so that these messages can still be
+# stored, but the json_filters of Message.grep() don't match them.
+MSG_JSONB_DDL = [
+    "CREATE OR REPLACE FUNCTION datanommer_msg_jsonb(msg text) RETURNS jsonb "
+    "LANGUAGE plpgsql IMMUTABLE PARALLEL SAFE AS $$ "
+    "BEGIN RETURN msg::jsonb; "
+    "EXCEPTION WHEN invalid_text_representation OR untranslatable_character "
+    "THEN RETURN NULL; "
+    "END $$",
+    "CREATE INDEX IF NOT EXISTS messages_msg_json ON messages "
+    "USING gin (datanommer_msg_jsonb(_msg) jsonb_path_ops)",
+]
+
+for _statement in MSG_JSONB_DDL:
+    event.listen(
+        Message.__table__,
+        "after_create",
+        DDL(_statement).execute_if(dialect="postgresql"),
+    )
+
+
+def _json_path_equals(path, value, dialect):
+    """Return a filter on the messages where the dotted path has the value.
+
+    Objects and arrays must be equal, not only contain the value, and the
+    types of the scalars must match, so that PostgreSQL and SQLite agree.
+    """
+    keys = path.split(".")
+    if dialect.name == "postgresql":
+        msg = func.datanommer_msg_jsonb(Message._msg, type_=postgresql.JSONB)
+        # A containment test, which the index on the JSON of the messages
+        # serves.  It must use the indexed expression as is.
+        document = value
+        for key in reversed(keys):
+            document = {key: document}
+        containment = msg.contains(document)
+        if not isinstance(value, (dict, list)):
+            return containment
+        # Containment is looser for objects and arrays.
+        return and_(containment, msg[tuple(keys)] == value)
+    return _sqlite_json_equals(keys, value)
+
+
+def _sqlite_json_equals(keys, value):
+    json_path = "$" + "".join(
+        "[%d]" % key if isinstance(key, int) else '."%s"' % key for key in keys
+    )
+    kind = func.json_type(Message._msg, json_path)
+    if value is None:
+        return kind == "null"
+    if isinstance(value, bool):
+        return kind == ("true" if value else "false")
+    if isinstance(value, dict):
+        items = select([func.count()]).select_from(
+            func.json_each(Message._msg, json_path)
+        )
+        return and_(
+            kind == "object",
+            items.scalar_subquery() == len(value),
+            *(_sqlite_json_equals(keys + [k], v) for k, v in value.items()),
+        )
+    if isinstance(value, list):
+        return and_(
+            kind == "array",
+            func.json_array_length(Message._msg, json_path) == len(value),
+            *(_sqlite_json_equals(keys + [i], v) for i, v in enumerate(value)),
+        )
+    # json_extract() returns true and false as 1 and 0, hence the types.
+    types = ["integer", "real"] if isinstance(value, (int, float)) else ["text"]
+    return and_(kind.in_(types), func.json_extract(Message._msg, json_path) == value)
+
+
+@event.listens_for(Message, "after_insert")
+def _update_latest_after_insert(mapper, connection, target):
+    # The messages stored with add() are recorded by add_prepared(), but not
+    # the Message instances added to the session.
+    message = {
+        "id": target.id,
+        "topic": target.topic,
+        "category": target.category,
+        "timestamp": target.timestamp,
+    }
+    _update_latest(connection, [message])
+
+
+def _associated_with(column, names):
+    """Return a filter on the messages associated with any of the names in the
+    column of an association table, as a single semi-join."""
+    msg = column.table.c.msg
+    return Message.id.in_(select([msg]).where(column.in_(names)))
+
+
+def _not_associated_with(column, names):
+    """Return a filter on the messages associated with none of the names in
+    the column of an association table, as a single anti-join."""
+    msg = column.table.c.msg
+    return ~exists().where(msg == Message.id).where(column.in_(names))
+
+
+def _count(query, mode, cap):
+    if mode == "exact":
+        return query.count()
+    elif mode == "none":
+        return None
+    elif mode == "capped":
+        return query.limit(cap).count()
+    elif mode == "estimate":
+        estimate = _estimate_count(query)
+        return query.count() if estimate is None else estimate
+    raise ValueError(f"Unknown count mode: {mode!r}")
+
+
+def _estimate_count(query):
+    """Return the number of rows that the PostgreSQL query planner expects a
+    query to return, or None with other databases."""
+    bind = session.get_bind()
+    if bind.dialect.name != "postgresql":
+        return None
+    compiled = query.statement.compile(
+        dialect=bind.dialect, compile_kwargs={"render_postcompile": True}
+    )
+    plan = (
+        session.connection()
+        .exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params)
+        .scalar()
+    )
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+CURSOR_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def _encode_cursor(message):
+    value = f"{message.timestamp.strftime(CURSOR_TIMESTAMP_FORMAT)},{message.id}"
+    return base64.urlsafe_b64encode(value.encode("ascii")).decode("ascii")
+
+
+def _decode_cursor(cursor):
+    try:
+        value = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("ascii")
+        timestamp, id_ = value.split(",")
+        return (
+            datetime.datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT),
+            int(id_),
+        )
+    except (AttributeError, binascii.Error, UnicodeError, ValueError):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
 
 models = frozenset(
     (
@@ -0,0 +1,202 @@
+# This file is a part of datanommer, a message sink for fedmsg.
+# Copyright (C) 2014, Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""An optional full-text index of the messages, used by the ``search``
+argument of :meth:`datanommer.models.Message.grep`.
+
+With PostgreSQL, the index is a ``search_vector`` tsvector column of the
+messages table with a GIN index.  With SQLite, it is a contentless FTS5
+table named ``messages_search``, whose rowids are the ids of the messages.
+In both cases, triggers index the messages as they are inserted or their JSON
+is updated (and remove deleted messages from the SQLite table), and the
+messages stored before the index was created are indexed by
+:func:`backfill`.
+
+The index makes storing messages slower, so it is only created on request,
+by the alembic migration with ``-x search_index=true`` or by the
+``datanommer-search-index --create`` command.
+"""
+import logging
+
+from sqlalchemy import func, inspect, literal_column, or_, select, text
+
+import datanommer.models
+
+
+log = logging.getLogger("datanommer")
+
+# The PostgreSQL text search configuration: messages are JSON in any
+# language, so words are only lowercased, not stemmed.
+CONFIGURATION = "pg_catalog.simple"
+
+# Default number of message ids indexed per transaction by backfill().
+DEFAULT_CHUNK_SIZE = 10000
+
+_SQLITE_UNINDEX = (
+    "INSERT INTO messages_search (messages_search, rowid, msg) "
+    "SELECT 'delete', old.id, old._msg "
+    "WHERE EXISTS (SELECT 1 FROM messages_search WHERE rowid = old.id)"
+)
+
+DDL = {
+    "postgresql": [
+        "ALTER TABLE messages ADD COLUMN search_vector tsvector",
+        "CREATE TRIGGER messages_search_vector_update "
+        "BEFORE INSERT OR UPDATE OF _msg ON messages FOR EACH ROW "
+        "EXECUTE PROCEDURE tsvector_update_trigger"
+        f"(search_vector, '{CONFIGURATION}', _msg)",
+    ],
+    "sqlite": [
+        "CREATE VIRTUAL TABLE messages_search USING fts5(msg, content='')",
+        "CREATE TRIGGER messages_search_insert AFTER INSERT ON messages BEGIN "
+        "INSERT INTO messages_search (rowid, msg) VALUES (new.id, new._msg); END",
+        # The table is contentless, so the words of a message are removed by
+        # giving its old JSON to the 'delete' command.  The messages that
+        # aren't indexed yet are skipped, it would corrupt the index.
+        "CREATE TRIGGER messages_search_update AFTER UPDATE OF _msg ON messages "
+        f"BEGIN {_SQLITE_UNINDEX}; "
+        "INSERT INTO messages_search (rowid, msg) VALUES (new.id, new._msg); END",
+        "CREATE TRIGGER messages_search_delete AFTER DELETE ON messages "
+        f"BEGIN {_SQLITE_UNINDEX}; END",
+    ],
+}
+
+# Built concurrently, outside of a transaction, see create_index().
+INDEX_DDL = {
+    "postgresql": [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_search_vector "
+        "ON messages USING gin (search_vector)",
+    ],
+    "sqlite": [],
+}
+
+# The pg_trgm index of the messages, which serves the LIKE patterns of the
+# ``contains`` argument of Message.grep(), built concurrently.
+TRIGRAM_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_msg_trgm ON messages "
+    "USING gin (_msg gin_trgm_ops)",
+]
+
+DROP_DDL = {
+    "postgresql": [
+        "DROP TRIGGER messages_search_vector_update ON messages",
+        "ALTER TABLE messages DROP COLUMN search_vector",
+    ],
+    "sqlite": [
+        "DROP TRIGGER messages_search_insert",
+        "DROP TRIGGER IF EXISTS messages_search_update",
+        "DROP TRIGGER IF EXISTS messages_search_delete",
+        "DROP TABLE messages_search",
+    ],
+}
+
+# Index the messages with an id in (:low, :high] that aren't indexed yet.
+BACKFILL = {
+    "postgresql": (
+        f"UPDATE messages SET search_vector = to_tsvector('{CONFIGURATION}', _msg) "
+        "WHERE id > :low AND id <= :high AND search_vector IS NULL"
+    ),
+    "sqlite": (
+        "INSERT INTO messages_search (rowid, msg) SELECT id, _msg FROM messages "
+        "WHERE id > :low AND id <= :high AND id NOT IN "
+        "(SELECT rowid FROM messages_search WHERE rowid > :low AND rowid <= :high)"
+    ),
+}
+
+
+def _dialect(dialect):
+    if dialect.name not in DDL:
+        raise ValueError(f"Full-text search is not supported with {dialect.name}")
+    return dialect.name
+
+
+def create(bind):
+    """Create the full-text index of the messages with a connection or an
+    engine.  Existing messages must then be indexed with :func:`backfill`,
+    and the index built by :func:`create_index`."""
+    for statement in DDL[_dialect(bind.dialect)]:
+        bind.execute(text(statement))
+
+
+def create_index(bind):
+    """Build the GIN index of the search vectors with PostgreSQL, if it
+    doesn't exist yet.  It is built concurrently, so that messages can be
+    stored meanwhile, which needs a connection in autocommit mode."""
+    for statement in INDEX_DDL[_dialect(bind.dialect)]:
+        bind.execute(text(statement))
+
+
+def create_trigram_index(bind):
+    """Build the trigram index of the messages, if it doesn't exist yet.  It
+    is only supported with PostgreSQL, and built concurrently like
+    :func:`create_index`."""
+    if bind.dialect.name != "postgresql":
+        raise ValueError("Trigram indexes are only supported with PostgreSQL")
+    for statement in TRIGRAM_DDL:
+        bind.execute(text(statement))
+
+
+def exists(bind):
+    """Whether the full-text index of the messages was created."""
+    inspector = inspect(bind)
+    if _dialect(bind.dialect) == "postgresql":
+        columns = inspector.get_columns("messages")
+        return any(column["name"] == "search_vector" for column in columns)
+    return inspector.has_table("messages_search")
+
+
+def drop(bind):
+    """Drop the full-text index of the messages."""
+    for statement in DROP_DDL[_dialect(bind.dialect)]:
+        bind.execute(text(statement))
+
+
+def backfill(chunk_size=DEFAULT_CHUNK_SIZE):
+    """Index the messages that were stored before the full-text index was
+    created, ``chunk_size`` message ids per transaction.
+
+    It can be interrupted and run again, and the consumer can keep storing
+    messages meanwhile.  Returns the number of messages that were indexed.
+    """
+    session = datanommer.models.session
+    statement = text(BACKFILL[_dialect(session.get_bind().dialect)])
+    Message = datanommer.models.Message
+    last_id = session.query(func.max(Message.id)).scalar() or 0
+    count = 0
+    for low in range(0, last_id, chunk_size):
+        high = min(low + chunk_size, last_id)
+        result = session.execute(statement, {"low": low, "high": high})
+        session.commit()
+        count += max(result.rowcount, 0)
+        log.info("Indexed messages up to id %d of %d", high, last_id)
+    return count
+
+
+def matches(phrases, dialect):
+    """Return a filter on the messages containing any of the phrases."""
+    Message = datanommer.models.Message
+    if _dialect(dialect) == "postgresql":
+        vector = literal_column("messages.search_vector")
+        return or_(
+            *(
+                vector.op("@@")(func.phraseto_tsquery(CONFIGURATION, phrase))
+                for phrase in phrases
+            )
+        )
+    # Quote the phrases, so that they aren't parsed as FTS5 queries.
+    query = " OR ".join('"%s"' % phrase.replace('"', '""') for phrase in phrases)
+    rowids = select([literal_column("rowid")]).select_from(text("messages_search"))
+    return Message.id.in_(rowids.where(literal_column("messages_search").match(query)))
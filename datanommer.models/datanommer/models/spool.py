@@ -0,0 +1,261 @@
+# This file is a part of datanommer, a message sink for fedmsg.
+# Copyright (C) 2014, Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""An on-disk spool of fedmsg envelopes waiting to be stored in the db.
+
+The spool is a directory of append-only segment files.  Each record is the
+JSON-encoded envelope, prefixed with its length and its CRC32 as two
+big-endian 32-bit integers.  Messages are appended to the open segment
+(``<number>.spool.open``), which is closed (renamed to ``<number>.spool``)
+when it reaches its maximum size, when the spool is closed, or before a
+replay.  Only closed segments are replayed, and each one is deleted once all
+of its messages are stored.
+
+The consumer writes to the spool while the database is unavailable, and the
+``datanommer-spool`` command can inspect and replay it.
+"""
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+import fedmsg.encoding
+import sqlalchemy.exc
+
+import datanommer.models
+
+
+log = logging.getLogger("datanommer")
+
+HEADER = struct.Struct(">II")
+SUFFIX = ".spool"
+OPEN_SUFFIX = SUFFIX + ".open"
+
+# Default maximum size of a segment, in bytes.
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+# When to fsync the segments: after every message, when a segment is closed,
+# or never (the data is still flushed to the OS after every message).
+FSYNC_POLICIES = ("always", "segment", "never")
+
+# Errors meaning that the database can't be used at the moment, rather than
+# that a message can't be stored.
+UNAVAILABLE_ERRORS = (sqlalchemy.exc.OperationalError, sqlalchemy.exc.InterfaceError)
+
+
+class Spool:
+    """A spool of messages in the ``path`` directory, created if needed.
+
+    There must be only one instance for a given directory at a time, because
+    it takes over the segments that were left open.
+    """
+
+    def __init__(self, path, segment_size=DEFAULT_SEGMENT_SIZE, fsync="segment"):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {', '.join(FSYNC_POLICIES)}")
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self._file = None
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        # Segments left open by a crash are complete, except maybe for their
+        # last record which read() will skip.
+        for name in os.listdir(path):
+            if name.endswith(OPEN_SUFFIX):
+                filename = os.path.join(path, name)
+                os.rename(filename, filename[: -len(".open")])
+        self._next_number = max(
+            (_segment_number(name) for name in os.listdir(path) if _is_segment(name)),
+            default=0,
+        )
+
+    def is_empty(self):
+        with self._lock:
+            return self._file is None and not segments(self.path)
+
+    def append(self, envelope):
+        """Write a message at the end of the spool.
+
+        Messages without a msg_id are given the one that storing them would
+        generate, so that replaying them again after a partial replay
+        doesn't store them twice.
+        """
+        payload = fedmsg.encoding.dumps(_identified(envelope)).encode("utf-8")
+        record = HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            if self._file is None:
+                self._next_number += 1
+                filename = os.path.join(
+                    self.path, f"{self._next_number:016d}{OPEN_SUFFIX}"
+                )
+                self._file = open(filename, "ab")
+            self._file.write(record)
+            self._file.flush()
+            if self.fsync == "always":
+                os.fsync(self._file.fileno())
+            if self._file.tell() >= self.segment_size:
+                self._close_segment()
+
+    def rotate(self):
+        """Close the open segment, so that its messages can be replayed."""
+        with self._lock:
+            if self._file is not None:
+                self._close_segment()
+
+    close = rotate
+
+    def _close_segment(self):
+        # Must be called with the lock held.
+        if self.fsync != "never":
+            os.fsync(self._file.fileno())
+        self._file.close()
+        os.rename(self._file.name, self._file.name[: -len(".open")])
+        self._file = None
+
+    def replay(self, store, batch_size=1000):
+        """Close the open segment and replay all the segments, see
+        :func:`replay`."""
+        self.rotate()
+        return replay(self.path, store, batch_size)
+
+
+def _identified(envelope):
+    """Return the envelope with the msg_id and the timestamp that storing it
+    would generate, if it has none."""
+    body = envelope.get("body")
+    headers = envelope.get("headers") or {}
+    if not isinstance(body, dict) or body.get("msg_id") or headers.get("message-id"):
+        return envelope
+    body = dict(body)
+    if not body.get("timestamp"):
+        body["timestamp"] = time.time()
+    envelope = dict(envelope, body=body)
+    try:
+        body["msg_id"] = datanommer.models._message_values(envelope)["msg_id"]
+    except Exception:
+        # A broken message, which will be skipped when it is replayed.
+        pass
+    return envelope
+
+
+def segments(path, include_open=False):
+    """Return the paths of the segments in a spool directory, oldest first.
+
+    The open segment, which may still be written to, is only included if
+    ``include_open`` is set.
+    """
+    names = sorted(
+        (
+            name
+            for name in os.listdir(path)
+            if name.endswith(SUFFIX) or (include_open and name.endswith(OPEN_SUFFIX))
+        ),
+        key=_segment_number,
+    )
+    return [os.path.join(path, name) for name in names]
+
+
+def replay(path, store, batch_size=1000):
+    """Pass the messages of the closed segments of a spool to ``store`` in
+    lists of up to ``batch_size`` messages, oldest first, and delete each
+    segment once all of its messages are stored.
+
+    If ``store`` raises an exception, it is propagated and the segment being
+    replayed is kept, to be replayed from its beginning next time.  Returns the
+    number of messages that were replayed.
+    """
+    count = 0
+    for segment in segments(path):
+        batch = []
+        for envelope in read(segment):
+            batch.append(envelope)
+            if len(batch) >= batch_size:
+                store(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            store(batch)
+            count += len(batch)
+        try:
+            os.unlink(segment)
+        except FileNotFoundError:
+            # Another process replayed it at the same time.
+            pass
+        log.info("Replayed the spool segment %s", segment)
+    return count
+
+
+def store(envelopes):
+    """Store messages read from a spool in the database.
+
+    Messages that can't be stored are logged and skipped, but the errors caused
+    by the database being unavailable are raised, so that the messages stay in
+    the spool.
+    """
+    try:
+        datanommer.models.add_many(envelopes)
+        return
+    except UNAVAILABLE_ERRORS:
+        datanommer.models.session.rollback()
+        raise
+    except Exception:
+        datanommer.models.session.rollback()
+        log.exception("Could not store spooled messages, retrying them one by one")
+    for envelope in envelopes:
+        try:
+            datanommer.models.add(envelope)
+        except UNAVAILABLE_ERRORS:
+            datanommer.models.session.rollback()
+            raise
+        except Exception:
+            datanommer.models.session.rollback()
+            log.exception("Could not store spooled message %r", envelope)
+
+
+def read(segment):
+    """Yield the messages stored in a segment file.
+
+    Reading stops at the first truncated or corrupted record, such as the
+    last one written before a crash.
+    """
+    with open(segment, "rb") as f:
+        while True:
+            offset = f.tell()
+            header = f.read(HEADER.size)
+            if not header:
+                return
+            if len(header) == HEADER.size:
+                length, checksum = HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) == length and zlib.crc32(payload) == checksum:
+                    yield fedmsg.encoding.loads(payload.decode("utf-8"))
+                    continue
+            log.warning(
+                "Skipping a truncated or corrupted record at offset %d of %s",
+                offset,
+                segment,
+            )
+            return
+
+
+def _is_segment(name):
+    return name.endswith(SUFFIX) or name.endswith(OPEN_SUFFIX)
+
+
+def _segment_number(name):
+    return int(name.split(".", 1)[0])
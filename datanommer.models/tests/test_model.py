@@ -15,9 +15,11 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 import copy
 import datetime
+import json
+import math
 import pprint
 import unittest
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 import pytest
 import sqlalchemy
@@ -194,8 +196,9 @@ class TestModels(unittest.TestCase):
         datanommer.models.session.close()
 
         # These contain objects bound to the old session, so we have to flush.
-        datanommer.models._users_seen = set()
-        datanommer.models._packages_seen = set()
+        datanommer.models._users_seen.clear()
+        datanommer.models._packages_seen.clear()
+        datanommer.models.stats.clear()
 
     def test_add_empty(self):
         with pytest.raises(KeyError):
@@ -260,17 +263,187 @@ class TestModels(unittest.TestCase):
         # Add it to the db and check how many queries we made
         datanommer.models.add(msg)
         if "sqlite" in datanommer.models.session.get_bind().driver:
-            assert len(statements) == 12
+            assert len(statements) == 8
         else:
-            assert len(statements) == 11
+            assert len(statements) == 7
 
         # Add it again and check again
         datanommer.models.add(msg)
         pprint.pprint(statements)
         if "sqlite" in datanommer.models.session.get_bind().driver:
-            assert len(statements) == 16
-        else:
             assert len(statements) == 14
+        else:
+            assert len(statements) == 12
+
+    def test_add_many(self):
+        envelopes = [
+            copy.deepcopy(scm_message),
+            copy.deepcopy(github_message),
+            copy.deepcopy(umb_message),
+        ]
+        assert datanommer.models.add_many(envelopes) == 3
+        assert datanommer.models.Message.query.count() == 3
+        assert datanommer.models.User.query.count() == 1
+        assert datanommer.models.Package.query.count() == 1
+
+        dbmsg = datanommer.models.Message.query.filter_by(
+            topic=scm_message["body"]["topic"]
+        ).one()
+        assert dbmsg.category == "git"
+        assert dbmsg.msg == scm_message["body"]["msg"]
+        assert dbmsg.headers == {}
+        assert [user.name for user in dbmsg.users] == ["mjw"]
+        assert [package.name for package in dbmsg.packages] == ["valgrind"]
+
+        dbmsg = datanommer.models.Message.from_msg_id(umb_message["body"]["msg_id"])
+        assert dbmsg.category == "brew"
+        assert dbmsg.headers == umb_message["headers"]
+
+    def test_add_prepared(self):
+        prepared = datanommer.models.prepare(copy.deepcopy(scm_message))
+        assert prepared.row["category"] == "git"
+        assert prepared.usernames == {"mjw"}
+        assert prepared.packages == {"valgrind"}
+        assert prepared.message is None
+
+        # Nothing was written while preparing the message.
+        assert datanommer.models.Message.query.count() == 0
+
+        assert datanommer.models.add_prepared([prepared]) == 1
+        dbmsg = datanommer.models.Message.query.one()
+        assert dbmsg.msg == scm_message["body"]["msg"]
+        assert [user.name for user in dbmsg.users] == ["mjw"]
+        assert [package.name for package in dbmsg.packages] == ["valgrind"]
+
+    def test_add_source_version(self):
+        with patch("pkg_resources.get_distribution") as get_distribution:
+            get_distribution.return_value.version = "1.2.3"
+            datanommer.models._source_version.cache_clear()
+            self.addCleanup(datanommer.models._source_version.cache_clear)
+            datanommer.models.add(copy.deepcopy(scm_message))
+            datanommer.models.add(copy.deepcopy(github_message))
+        assert get_distribution.call_count == 1
+        assert [m.source_version for m in datanommer.models.Message.query] == [
+            "1.2.3",
+            "1.2.3",
+        ]
+
+    def test_codecs(self):
+        fixtures = [scm_message, github_message, umb_message]
+        for name, codec in datanommer.models.CODECS.items():
+            for fixture in fixtures:
+                text = codec.dumps(fixture)
+                for other in datanommer.models.CODECS.values():
+                    assert other.loads(text) == fixture, name
+
+        # The default codec is what datanommer has always stored.
+        assert datanommer.models.CODECS["fedmsg"].dumps({"b": 1, "a": [2]}) == (
+            '{"a":[2],"b":1}'
+        )
+
+    def test_set_codec(self):
+        self.addCleanup(datanommer.models.set_codec, "fedmsg")
+        datanommer.models.set_codec("json")
+        datanommer.models.add(copy.deepcopy(umb_message))
+        dbmsg = datanommer.models.Message.query.one()
+        assert dbmsg._headers == json.dumps(
+            umb_message["headers"], separators=(",", ":")
+        )
+        datanommer.models.set_codec("fedmsg")
+        assert dbmsg.headers == umb_message["headers"]
+
+        with pytest.raises(ValueError):
+            datanommer.models.set_codec("pickle")
+
+    def test_init_twice_keeps_codec(self):
+        self.addCleanup(datanommer.models.set_codec, "fedmsg")
+        datanommer.models.set_codec("json")
+        # Initializing again does nothing, the codec included.
+        datanommer.models.init(self.fname, codec="fedmsg")
+        assert datanommer.models._codec is datanommer.models.CODECS["json"]
+
+    @pytest.mark.skipif(datanommer.models.orjson is None, reason="needs orjson")
+    def test_orjson_codec(self):
+        dumps = datanommer.models.CODECS["orjson"].dumps
+        assert dumps({1: {2, 3}}) == '{"1":[2,3]}'
+        # Integers larger than 64 bits are handled by the json codec.
+        assert dumps({"a": 2**70}) == '{"a":%d}' % 2**70
+
+    def test_codecs_round_trip(self):
+        payload = {
+            "nan": float("nan"),
+            "infinities": [float("inf"), float("-inf")],
+            "surrogate": "\udc80",
+            "null": None,
+        }
+        codecs = datanommer.models.CODECS
+        for writer in codecs.values():
+            text = writer.dumps(payload)
+            for reader in codecs.values():
+                loaded = reader.loads(text)
+                assert math.isnan(loaded["nan"])
+                assert loaded["infinities"] == [float("inf"), float("-inf")]
+                assert loaded["surrogate"] == "\udc80"
+                assert loaded["null"] is None
+        if "orjson" in codecs:
+            # Without the lone surrogate, orjson writes NaN and infinities.
+            text = codecs["orjson"].dumps({"nan": float("nan"), "inf": float("inf")})
+            assert json.loads(text) == {"nan": None, "inf": None}
+
+    def test_memoized_payloads(self):
+        datanommer.models.add(copy.deepcopy(umb_message))
+        dbmsg = datanommer.models.Message.query.one()
+        codec = datanommer.models._codec
+        with patch("datanommer.models._codec") as mocked_codec:
+            mocked_codec.loads.side_effect = codec.loads
+            mocked_codec.dumps.side_effect = codec.dumps
+            assert dbmsg.msg == umb_message["body"]["msg"]
+            assert dbmsg.msg is dbmsg.msg
+            assert dbmsg.headers is dbmsg.headers
+            dbmsg.__json__()
+            assert mocked_codec.loads.call_count == 2
+
+            # Setting or reloading the columns invalidates the parsed payloads.
+            dbmsg.msg = {"foo": "bar"}
+            assert dbmsg.msg == {"foo": "bar"}
+            datanommer.models.session.expire(dbmsg)
+            assert dbmsg.headers == umb_message["headers"]
+            assert mocked_codec.loads.call_count == 4
+
+            dbmsg.memoize_payloads = False
+            dbmsg.headers
+            dbmsg.headers
+            assert mocked_codec.loads.call_count == 6
+
+    def test_add_many_duplicates(self):
+        datanommer.models.add(copy.deepcopy(github_message))
+        envelopes = [
+            copy.deepcopy(github_message),
+            copy.deepcopy(umb_message),
+            copy.deepcopy(umb_message),
+        ]
+        assert datanommer.models.add_many(envelopes) == 1
+        assert datanommer.models.Message.query.count() == 2
+        assert datanommer.models.stats["duplicate_messages"] == 2
+
+    def test_add_many_count_statements(self):
+        statements = []
+
+        def track(conn, cursor, statement, param, ctx, many):
+            statements.append(statement)
+
+        engine = datanommer.models.session.get_bind()
+        sqlalchemy.event.listen(engine, "before_cursor_execute", track)
+
+        envelopes = []
+        for index in range(200):
+            msg = copy.deepcopy(scm_message)
+            msg["body"]["msg_id"] = "msg-%d" % index
+            envelopes.append(msg)
+        datanommer.models.add_many(envelopes)
+        assert datanommer.models.Message.query.count() == 200
+        # The number of statements does not depend on the number of messages
+        assert len(statements) < 25
 
     def test_add_missing_cert(self):
         msg = copy.deepcopy(scm_message)
@@ -355,6 +528,353 @@ class TestModels(unittest.TestCase):
         assert p == 0
         assert len(r) == 0
 
+    def _add_messages_for_grep(self):
+        # Three messages per timestamp, to check that ties are stable.
+        envelopes = []
+        for i in range(9):
+            envelope = copy.deepcopy(scm_message)
+            envelope["body"]["msg_id"] = str(i)
+            envelope["body"]["timestamp"] = 1344350850 + i // 3
+            envelopes.append(envelope)
+        datanommer.models.add_many(envelopes)
+
+    def test_grep_cursor(self):
+        self._add_messages_for_grep()
+        grep = datanommer.models.Message.grep
+        t, p, r, cursor = grep(rows_per_page=4, cursor=True, count="exact")
+        assert (t, p) == (9, 3)
+        msg_ids = [m.msg_id for m in r]
+        while cursor is not None:
+            t, p, r, cursor = grep(rows_per_page=4, cursor=cursor)
+            # The following pages aren't counted by default.
+            assert (t, p) == (None, None)
+            msg_ids.extend(m.msg_id for m in r)
+        assert msg_ids == [str(i) for i in range(9)]
+
+        t, p, r, cursor = grep(rows_per_page=5, order="desc", cursor=True)
+        assert [m.msg_id for m in r] == ["8", "7", "6", "5", "4"]
+        t, p, r, cursor = grep(rows_per_page=5, order="desc", cursor=cursor)
+        assert [m.msg_id for m in r] == ["3", "2", "1", "0"]
+        assert cursor is None
+
+        # The pages are the same as with page numbers.
+        t, p, r = grep(rows_per_page=4, page=2)
+        assert [m.msg_id for m in r] == ["4", "5", "6", "7"]
+
+    def test_grep_cursor_filters(self):
+        self._add_messages_for_grep()
+        datanommer.models.add(copy.deepcopy(github_message))
+        t, p, r, cursor = datanommer.models.Message.grep(
+            categories=["git"], rows_per_page=8, cursor=True
+        )
+        t, p, r, cursor = datanommer.models.Message.grep(
+            categories=["git"], rows_per_page=8, cursor=cursor
+        )
+        assert [m.msg_id for m in r] == ["8"]
+        assert cursor is None
+
+        t, p, query, cursor = datanommer.models.Message.grep(
+            rows_per_page=8, cursor=True, defer=True, count="exact"
+        )
+        assert (t, p, cursor) == (10, 2, None)
+        assert query.count() == 8
+
+    def test_grep_count(self):
+        self._add_messages_for_grep()
+        grep = datanommer.models.Message.grep
+        t, p, r = grep(rows_per_page=4, count="none")
+        assert (t, p, len(r)) == (None, None, 4)
+        t, p, r = grep(rows_per_page=4, count="capped", count_cap=5)
+        assert (t, p, len(r)) == (5, 2, 4)
+        t, p, r = grep(rows_per_page=4, count="capped", count_cap=50)
+        assert (t, p) == (9, 3)
+        # SQLite has no estimates, the messages are counted.
+        t, p, r = grep(rows_per_page=4, count="estimate")
+        assert (t, p) == (9, 3)
+        with patch("datanommer.models._estimate_count", return_value=1000):
+            t, p, r = grep(rows_per_page=4, count="estimate")
+        assert (t, p) == (1000, 250)
+
+        with pytest.raises(ValueError):
+            grep(count="roughly")
+
+    def test_grep_users_and_packages(self):
+        # mjw and valgrind
+        datanommer.models.add(copy.deepcopy(scm_message))
+        msg = copy.deepcopy(scm_message)
+        msg["body"]["msg"]["commit"]["username"] = "ralph"
+        msg["body"]["msg"]["commit"]["repo"] = "kernel"
+        datanommer.models.add(msg)
+        # no user and no package
+        datanommer.models.add(copy.deepcopy(github_message))
+
+        def grep(**kwargs):
+            t, p, r = datanommer.models.Message.grep(order="asc", **kwargs)
+            return sorted(m.category for m in r), sorted(
+                user.name for m in r for user in m.users
+            )
+
+        assert grep(users=["mjw", "ralph"]) == (["git", "git"], ["mjw", "ralph"])
+        assert grep(users=["ralph", "nobody"]) == (["git"], ["ralph"])
+        assert grep(not_users=["mjw"]) == (["git", "github"], ["ralph"])
+        assert grep(not_users=["mjw", "ralph"]) == (["github"], [])
+        assert grep(packages=["kernel"]) == (["git"], ["ralph"])
+        assert grep(not_packages=["kernel", "valgrind"]) == (["github"], [])
+        assert grep(users=["mjw", "ralph"], not_packages=["valgrind"]) == (
+            ["git"],
+            ["ralph"],
+        )
+
+    def test_grep_contains(self):
+        datanommer.models.add(copy.deepcopy(scm_message))
+        datanommer.models.add(copy.deepcopy(github_message))
+
+        def grep(*strings, literal=False):
+            t, p, r = datanommer.models.Message.grep(
+                contains=list(strings), contains_literal=literal
+            )
+            return sorted(m.category for m in r)
+
+        assert grep("valgrind.spec") == ["git"]
+        assert grep("hamm", "logically") == ["git", "github"]
+        # The strings are LIKE patterns.
+        assert grep("valgrind_spec") == ["git"]
+        assert grep("logically%awesome") == ["github"]
+        # Unless they are literal: the wildcards match themselves only.
+        assert grep("valgrind.spec", literal=True) == ["git"]
+        assert grep("valgrind_spec", literal=True) == []
+        assert grep("logically%awesome", literal=True) == []
+        assert grep("100%", literal=True) == []
+
+    def test_grep_json_filters(self):
+        datanommer.models.add(copy.deepcopy(scm_message))
+        datanommer.models.add(copy.deepcopy(github_message))
+
+        def grep(**json_filters):
+            t, p, r = datanommer.models.Message.grep(json_filters=json_filters)
+            return sorted(m.category for m in r)
+
+        assert grep(**{"commit.username": "mjw"}) == ["git"]
+        assert grep(**{"commit.username": "ralph"}) == []
+        assert grep(**{"commit.stats.total.lines": 3}) == ["git"]
+        assert grep(**{"hook.active": True, "hook.config.content_type": "json"}) == [
+            "github"
+        ]
+        assert grep(**{"hook.active": False}) == []
+        assert grep(**{"hook.active": True, "commit.username": "mjw"}) == []
+        # Types must match: true isn't 1, and 3 isn't "3".
+        assert grep(**{"hook.active": 1}) == []
+        assert grep(**{"commit.stats.total.lines": "3"}) == []
+        # Objects and arrays must be equal, not only contain the value.
+        assert grep(**{"hook.events": ["*"]}) == ["github"]
+        assert grep(**{"hook.events": []}) == []
+        response = {"code": None, "message": None, "status": "unused"}
+        assert grep(**{"hook.last_response": response}) == ["github"]
+        assert grep(**{"hook.last_response": {"status": "unused"}}) == []
+        # A null value, but not a missing one.
+        assert grep(**{"hook.last_response.message": None}) == ["github"]
+        assert grep(**{"hook.nothing": None}) == []
+
+        # PostgreSQL uses the indexed expression.
+        query = datanommer.models.Message.query.filter(
+            datanommer.models._json_path_equals(
+                "update.status", "stable", sqlalchemy.dialects.postgresql.dialect()
+            )
+        )
+        sql = str(
+            query.statement.compile(dialect=sqlalchemy.dialects.postgresql.dialect())
+        )
+        assert "datanommer_msg_jsonb(messages._msg) @> " in sql
+
+    def test_grep_search(self):
+        from datanommer.models import search
+
+        datanommer.models.add(copy.deepcopy(scm_message))
+        search.create(datanommer.models.session.connection())
+        datanommer.models.add(copy.deepcopy(github_message))
+
+        def grep(*phrases):
+            t, p, r = datanommer.models.Message.grep(search=list(phrases))
+            return sorted(m.category for m in r)
+
+        # The messages stored before the index was created aren't indexed yet.
+        assert grep("hammer") == []
+        assert grep("logically awesome") == ["github"]
+        assert search.backfill(chunk_size=1) == 1
+        assert search.backfill() == 0
+        assert grep("hammer") == ["git"]
+        assert grep("HAMMER", "logically awesome") == ["git", "github"]
+        # Phrases match words in order, not substrings.
+        assert grep("awesome logically") == []
+        assert grep("hamm") == []
+        assert grep('"hammer" OR awesome') == []
+
+    def test_grep_search_update(self):
+        from datanommer.models import search
+
+        datanommer.models.add(copy.deepcopy(scm_message))
+        search.create(datanommer.models.session.connection())
+        datanommer.models.add(copy.deepcopy(github_message))
+
+        def grep(*phrases):
+            t, p, r = datanommer.models.Message.grep(search=list(phrases))
+            return sorted(m.category for m in r)
+
+        github = datanommer.models.Message.query.filter_by(category="github").one()
+        github.msg = {"zen": "Keep it simple."}
+        datanommer.models.session.commit()
+        assert grep("logically awesome") == []
+        assert grep("simple") == ["github"]
+
+        # Deleting messages removes them from the index, unless they weren't
+        # indexed yet.
+        for message in datanommer.models.Message.query:
+            datanommer.models.session.delete(message)
+        datanommer.models.session.commit()
+        session = datanommer.models.session
+        if session.get_bind().dialect.name == "sqlite":
+            count = session.execute(
+                "SELECT count(*) FROM messages_search WHERE messages_search MATCH 'simple'"
+            )
+            assert count.scalar() == 0
+
+    def test_grep_columns(self):
+        datanommer.models.add(copy.deepcopy(scm_message))
+        datanommer.models.session.expunge_all()
+        t, p, r = datanommer.models.Message.grep(columns=["msg_id", "topic"])
+        assert t == 1
+        loaded = r[0].__dict__
+        assert loaded["topic"] == scm_message["body"]["topic"]
+        assert "_msg" not in loaded and "certificate" not in loaded
+        # The other columns are loaded on access.
+        assert r[0].msg == scm_message["body"]["msg"]
+        assert r[0].certificate == "blah"
+
+        t, p, r = datanommer.models.Message.grep(columns=["msg", "headers"])
+        assert "_msg" in r[0].__dict__ and "_headers" in r[0].__dict__
+
+        with pytest.raises(ValueError):
+            datanommer.models.Message.grep(columns=["payload"])
+
+    def test_latest_by_category(self):
+        self._add_messages_for_grep()
+        datanommer.models.add(copy.deepcopy(github_message))
+        latest = datanommer.models.Message.latest_by_category
+
+        messages = latest(["github", "bodhi", "git"])
+        assert [m.msg_id for m in messages] == [github_message["body"]["msg_id"], "8"]
+        # The timestamps of the git messages are in 2012, github's in 2014.
+        since = datetime.datetime(2013, 1, 1)
+        messages = latest(["git", "github"], since=since)
+        assert [m.category for m in messages] == ["github"]
+        assert latest([]) == []
+        assert [m.category for m in latest()] == ["git", "github"]
+
+        topic = scm_message["body"]["topic"]
+        messages = datanommer.models.Message.latest_by_topic([topic])
+        assert [m.msg_id for m in messages] == ["8"]
+
+    def test_add_without_on_conflict(self):
+        # Other dialects than PostgreSQL and SQLite insert plain rows.
+        plain_insert = patch(
+            "datanommer.models._insert_ignoring_duplicates",
+            lambda table: table.insert(),
+        )
+        with patch("datanommer.models._ignores_duplicates", return_value=False):
+            with plain_insert:
+                datanommer.models.add(copy.deepcopy(scm_message))
+                # As after a restart, the users and packages aren't cached.
+                datanommer.models._users_seen.clear()
+                datanommer.models._packages_seen.clear()
+                msg = copy.deepcopy(scm_message)
+                msg["body"]["msg_id"] = "other"
+                datanommer.models.add(msg)
+                datanommer.models.add(msg)
+
+        assert datanommer.models.Message.query.count() == 2
+        assert datanommer.models.User.query.count() == 1
+        assert datanommer.models.Package.query.count() == 1
+
+    def test_latest_without_on_conflict(self):
+        now = datetime.datetime.utcnow()
+        connection = datanommer.models.session.connection()
+        other = Mock(dialect=Mock(), execute=connection.execute)
+        other.dialect.name = "mssql"
+        for id_, minutes in ((1, 0), (2, 1), (3, -1)):
+            message = {
+                "id": id_,
+                "topic": "org.fedoraproject.prod.git.receive",
+                "category": "git",
+                "timestamp": now + datetime.timedelta(minutes=minutes),
+            }
+            datanommer.models._update_latest(other, [message])
+
+        table = datanommer.models.latest_category_table
+        assert connection.execute(table.select()).fetchall() == [
+            ("git", 2, now + datetime.timedelta(minutes=1))
+        ]
+
+    def test_latest_lock_order(self):
+        now = datetime.datetime.utcnow()
+        messages = [
+            {"id": i, "topic": topic, "category": topic[0], "timestamp": now}
+            for i, topic in enumerate(["c.1", "a.1", "b.1", "a.2"], 1)
+        ]
+        connection = Mock(dialect=sqlalchemy.dialects.sqlite.dialect())
+        datanommer.models._update_latest(connection, messages)
+        # The rows are upserted in the order of their keys.
+        topics, categories = (call.args[1] for call in connection.execute.mock_calls)
+        assert [value["topic"] for value in topics] == ["a.1", "a.2", "b.1", "c.1"]
+        assert [value["category"] for value in categories] == ["a", "b", "c"]
+
+    def test_latest_out_of_order(self):
+        msg = copy.deepcopy(scm_message)
+        msg["body"]["msg_id"] = "new"
+        datanommer.models.add(msg)
+        # An older message stored afterwards, like when replaying a spool.
+        msg = copy.deepcopy(scm_message)
+        msg["body"]["msg_id"] = "old"
+        msg["body"]["timestamp"] -= 60
+        datanommer.models.add(msg)
+        messages = datanommer.models.Message.latest_by_category(["git"])
+        assert [m.msg_id for m in messages] == ["new"]
+
+        # Messages added to the session are recorded too.
+        obj = datanommer.models.Message(
+            msg_id="orm",
+            topic=scm_message["body"]["topic"],
+            timestamp=datetime.datetime(2020, 1, 1),
+            i=1,
+        )
+        obj.msg = {}
+        datanommer.models.session.add(obj)
+        datanommer.models.session.flush()
+        messages = datanommer.models.Message.latest_by_topic(
+            [scm_message["body"]["topic"]]
+        )
+        assert [m.msg_id for m in messages] == ["orm"]
+
+    def test_grep_iter(self):
+        self._add_messages_for_grep()
+        datanommer.models.add(copy.deepcopy(github_message))
+        datanommer.models.session.expunge_all()
+
+        msg_ids = []
+        for message in datanommer.models.Message.grep_iter(
+            chunk_size=2, categories=["git"]
+        ):
+            msg_ids.append(message.msg_id)
+            assert [user.name for user in message.users] == ["mjw"]
+            # Only the current chunk and the user are kept in the session.
+            assert len(datanommer.models.session.identity_map) <= 3
+        assert sorted(msg_ids) == [str(i) for i in range(9)]
+        # Only the user is left.
+        assert len(datanommer.models.session.identity_map) == 1
+
+    def test_grep_invalid_cursor(self):
+        with pytest.raises(ValueError):
+            datanommer.models.Message.grep(cursor="not a cursor")
+
     def test_add_with_close_category(self):
         msg = copy.deepcopy(github_message)
         datanommer.models.add(msg)
@@ -403,6 +923,15 @@ class TestModels(unittest.TestCase):
         # if no exception was thrown, then we successfully ignored the
         # duplicate message
         assert datanommer.models.Message.query.count() == 1
+        assert datanommer.models.stats["duplicate_messages"] == 1
+
+    def test_add_duplicate_no_commit(self):
+        datanommer.models.add(copy.deepcopy(scm_message), commit=False)
+        datanommer.models.add(copy.deepcopy(github_message), commit=False)
+        datanommer.models.add(copy.deepcopy(github_message), commit=False)
+        datanommer.models.session.commit()
+        # The duplicate did not roll back the other messages
+        assert datanommer.models.Message.query.count() == 2
 
     def test_User_get_or_create(self):
         assert datanommer.models.User.query.count() == 0
@@ -418,6 +947,98 @@ class TestModels(unittest.TestCase):
         datanommer.models.Package.get_or_create("foo")
         assert datanommer.models.Package.query.count() == 1
 
+    def test_User_ensure(self):
+        datanommer.models.User.get_or_create("foo")
+        datanommer.models.User.ensure(["foo", "bar", "baz", "bar"])
+        names = [user.name for user in datanommer.models.User.query]
+        assert sorted(names) == ["bar", "baz", "foo"]
+
+    def test_Package_ensure(self):
+        datanommer.models.Package.ensure(["foo", "bar"])
+        datanommer.models.Package.ensure(["bar", "baz"])
+        names = [package.name for package in datanommer.models.Package.query]
+        assert sorted(names) == ["bar", "baz", "foo"]
+
+    def test_name_cache(self):
+        cache = datanommer.models.NameCache(capacity=2)
+        assert cache.missing(["foo", "bar"]) == {"foo", "bar"}
+        cache.update(["foo", "bar"])
+        assert cache.missing(["foo"]) == set()
+        # foo was used more recently than bar, which gets evicted.
+        cache.update(["baz"])
+        assert len(cache) == 2
+        assert "foo" in cache
+        assert "bar" not in cache
+        assert cache.missing(["bar", "baz"]) == {"bar"}
+        assert cache.hits == 2
+        assert cache.misses == 3
+
+    def test_processor_cache(self):
+        import fedmsg.meta
+
+        cache = datanommer.models.ProcessorCache(capacity=1)
+        message = copy.deepcopy(scm_message)["body"]
+        with patch(
+            "fedmsg.meta.msg2processor", wraps=fedmsg.meta.msg2processor
+        ) as msg2processor:
+            processor = cache.get(message)
+            assert processor is fedmsg.meta.msg2processor(message)
+            assert cache.get(message) is processor
+            # Only the first lookup and the check above walk the processors.
+            assert msg2processor.call_count == 2
+            assert (cache.hits, cache.misses) == (1, 1)
+
+            # The least recently used topic is evicted.
+            cache.get(copy.deepcopy(github_message)["body"])
+            assert len(cache) == 1
+            cache.get(message)
+            assert cache.misses == 3
+
+            # Adding a processor invalidates the cache.
+            with patch("fedmsg.meta.processors", fedmsg.meta.processors + [None]):
+                cache.get(message)
+            assert cache.misses == 4
+
+    def test_add_uses_cache(self):
+        datanommer.models.add(copy.deepcopy(scm_message))
+        assert datanommer.models._users_seen.misses == 1
+        assert datanommer.models._packages_seen.misses == 1
+        datanommer.models.add(copy.deepcopy(scm_message))
+        assert datanommer.models._users_seen.hits == 1
+        assert datanommer.models._packages_seen.hits == 1
+
+    def test_cache_after_rollback(self):
+        datanommer.models.add(copy.deepcopy(scm_message), commit=False)
+        datanommer.models.session.rollback()
+        # The users created by the rolled back transaction aren't remembered.
+        assert len(datanommer.models._users_seen) == 0
+        assert len(datanommer.models._packages_seen) == 0
+
+        datanommer.models.add(copy.deepcopy(scm_message))
+        dbmsg = datanommer.models.Message.query.one()
+        assert [user.name for user in dbmsg.users] == ["mjw"]
+        assert [package.name for package in dbmsg.packages] == ["valgrind"]
+        assert "mjw" in datanommer.models._users_seen
+        assert "valgrind" in datanommer.models._packages_seen
+
+    def test_cache_preload(self):
+        datanommer.models.add(copy.deepcopy(scm_message))
+        msg = copy.deepcopy(scm_message)
+        msg["body"]["msg"]["commit"]["username"] = "ralph"
+        datanommer.models.add(msg)
+
+        users = datanommer.models.NameCache(capacity=10)
+        packages = datanommer.models.NameCache(capacity=10)
+        datanommer.models._preload_cache(
+            users, datanommer.models.user_assoc_table.c.username, 1
+        )
+        datanommer.models._preload_cache(
+            packages, datanommer.models.pack_assoc_table.c.package, 1
+        )
+        assert "ralph" in users
+        assert "mjw" not in users
+        assert "valgrind" in packages
+
     @patch("datanommer.models.log")
     @patch("sqlalchemy.orm.query.Query.filter_by")
     def test_singleton_nested_txns(self, filter_by, log):
@@ -0,0 +1,161 @@
+# This file is a part of datanommer, a message sink for fedmsg.
+# Copyright (C) 2014, Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import pytest
+import sqlalchemy.exc
+from sqlalchemy.orm import scoped_session
+
+import datanommer.models
+from datanommer.models import spool
+
+
+def make_message(msg_id):
+    return {
+        "body": {
+            "topic": "org.fedoraproject.prod.git.receive.valgrind.master",
+            "i": 1,
+            "msg_id": msg_id,
+            "timestamp": 1344350850,
+            "msg": {"foo": "bar"},
+        }
+    }
+
+
+class TestSpool(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        import fedmsg.config
+        import fedmsg.meta
+
+        fedmsg.meta.make_processors(**fedmsg.config.load_config([], None))
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        datanommer.models.session = scoped_session(datanommer.models.maker)
+        datanommer.models.init("sqlite:///:memory:", create=True)
+
+    def tearDown(self):
+        datanommer.models.session.rollback()
+        engine = datanommer.models.session.get_bind()
+        datanommer.models.DeclarativeBase.metadata.drop_all(engine)
+        datanommer.models.session.close()
+        datanommer.models._users_seen.clear()
+        datanommer.models._packages_seen.clear()
+        datanommer.models.stats.clear()
+
+    def test_append_read(self):
+        s = spool.Spool(self.path)
+        s.append(make_message("1"))
+        s.append(make_message("2"))
+        # The open segment is not visible until it is closed.
+        assert spool.segments(self.path) == []
+        assert len(spool.segments(self.path, include_open=True)) == 1
+        assert not s.is_empty()
+        s.close()
+        segments = spool.segments(self.path)
+        assert [os.path.basename(segment) for segment in segments] == [
+            "0000000000000001.spool"
+        ]
+        assert list(spool.read(segments[0])) == [make_message("1"), make_message("2")]
+
+    def test_segment_rotation(self):
+        s = spool.Spool(self.path, segment_size=10, fsync="always")
+        for msg_id in "123":
+            s.append(make_message(msg_id))
+        assert len(spool.segments(self.path)) == 3
+        assert s.is_empty() is False
+
+    def test_invalid_fsync(self):
+        with pytest.raises(ValueError):
+            spool.Spool(self.path, fsync="sometimes")
+
+    def test_truncated_record(self):
+        s = spool.Spool(self.path, fsync="never")
+        s.append(make_message("1"))
+        s.append(make_message("2"))
+        s.close()
+        (segment,) = spool.segments(self.path)
+        with open(segment, "r+b") as f:
+            f.truncate(os.path.getsize(segment) - 3)
+        assert list(spool.read(segment)) == [make_message("1")]
+
+    def test_recover_open_segment(self):
+        s = spool.Spool(self.path)
+        s.append(make_message("1"))
+        # Simulate a crash: the segment is never closed.
+        s._file.close()
+        s = spool.Spool(self.path)
+        s.append(make_message("2"))
+        s.close()
+        segments = spool.segments(self.path)
+        assert len(segments) == 2
+        assert list(spool.read(segments[0])) == [make_message("1")]
+        assert list(spool.read(segments[1])) == [make_message("2")]
+
+    def test_replay(self):
+        s = spool.Spool(self.path, segment_size=10)
+        for msg_id in "123":
+            s.append(make_message(msg_id))
+        s.append(make_message("1"))
+        assert s.replay(spool.store, batch_size=2) == 4
+        assert s.is_empty()
+        assert spool.segments(self.path) == []
+        assert datanommer.models.Message.query.count() == 3
+
+    def test_replay_without_msg_id(self):
+        s = spool.Spool(self.path)
+        envelope = make_message("1")
+        del envelope["body"]["msg_id"], envelope["body"]["timestamp"]
+        s.append(envelope)
+        s.close()
+        # The msg_id is given when the message is spooled, so storing it
+        # again (after a partial replay) finds it already stored.
+        (segment,) = spool.segments(self.path)
+        (spooled,) = spool.read(segment)
+        assert spooled["body"]["msg_id"]
+        spool.store([spooled])
+        spool.store([spooled])
+        assert datanommer.models.Message.query.count() == 1
+        assert datanommer.models.Message.query.one().msg_id == spooled["body"]["msg_id"]
+
+    def test_replay_database_unavailable(self):
+        s = spool.Spool(self.path)
+        s.append(make_message("1"))
+        error = sqlalchemy.exc.OperationalError("INSERT", {}, Exception("down"))
+        with patch("datanommer.models.add_many", side_effect=error):
+            with pytest.raises(sqlalchemy.exc.OperationalError):
+                s.replay(spool.store)
+        # The message stays in the spool until it can be stored.
+        assert len(spool.segments(self.path)) == 1
+        assert s.replay(spool.store) == 1
+        assert datanommer.models.Message.query.count() == 1
+
+    def test_replay_broken_message(self):
+        s = spool.Spool(self.path)
+        broken = make_message("2")
+        del broken["body"]["msg"]
+        for envelope in (make_message("1"), broken, make_message("3")):
+            s.append(envelope)
+        assert s.replay(spool.store) == 3
+        # The broken message is skipped.
+        assert s.is_empty()
+        assert datanommer.models.Message.query.count() == 2
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+# This file is a part of datanommer, a message sink for fedmsg.
+# Copyright (C) 2014, Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+""" Compare the queries on the messages of a category or a topic in a time
+range, as done by datanommer-latest and Message.grep(), with and without the
+(category, timestamp) and (topic, timestamp) indexes, and print their plans.
+
+Usage: bench-category-queries.py [number of messages] [database uri]
+
+Without a database uri, a synthetic SQLite database is created in a temporary
+directory.  With one, its existing messages are used.  The composite indexes
+are dropped for the first run and created again for the second one.
+"""
+import datetime
+import random
+
+from benchlib import init, insert_messages, measure, message_row
+
+import datanommer.models as m
+
+
+CATEGORIES = [f"category{i}" for i in range(50)]
+TOPICS_PER_CATEGORY = 10
+
+
+def populate(count):
+    start = datetime.datetime(2020, 1, 1)
+
+    def make_row(id_):
+        # A few busy categories, like in production.
+        category = CATEGORIES[min(int(random.expovariate(0.2)), 49)]
+        topic = f"org.fedoraproject.prod.{category}.{random.randrange(10)}"
+        timestamp = start + datetime.timedelta(seconds=id_ * 60)
+        return message_row(id_, timestamp, topic, category)
+
+    insert_messages(count, make_row)
+
+
+def latest(categories, earliest):
+    # What datanommer-latest does for each category.
+    for category in categories:
+        m.Message.query.filter(
+            m.Message.category == category, m.Message.timestamp > earliest
+        ).order_by(m.Message.timestamp.desc()).limit(1).all()
+
+
+def grep(categories, start, end):
+    for category in categories:
+        m.Message.grep(categories=[category], start=start, end=end)
+
+
+def topic_grep(topics, start, end):
+    for topic in topics:
+        m.Message.grep(topics=[topic], start=start, end=end)
+
+
+def explain(query):
+    bind = m.session.get_bind()
+    compiled = query.statement.compile(
+        dialect=bind.dialect, compile_kwargs={"literal_binds": True}
+    )
+    prefix = "EXPLAIN QUERY PLAN" if bind.dialect.name == "sqlite" else "EXPLAIN"
+    rows = m.session.connection().exec_driver_sql(f"{prefix} {compiled}")
+    return "\n".join("    " + str(row[-1]) for row in rows)
+
+
+def main():
+    init(500000, populate)
+
+    last = m.session.query(m.func.max(m.Message.timestamp)).scalar()
+    earliest = last - datetime.timedelta(days=365)
+    end = last - datetime.timedelta(days=7)
+    start = end - datetime.timedelta(days=7)
+    categories = CATEGORIES[:20]
+    topics = [f"org.fedoraproject.prod.{c}.1" for c in categories]
+    indexes = [
+        index
+        for index in m.Message.__table__.indexes
+        if index.name in ("messages_category_timestamp", "messages_topic_timestamp")
+    ]
+    bind = m.session.get_bind()
+
+    for with_indexes in (False, True):
+        m.session.commit()
+        for index in indexes:
+            index.drop(bind, checkfirst=True)
+            if with_indexes:
+                index.create(bind)
+        if bind.dialect.name == "sqlite":
+            m.session.execute("ANALYZE")
+        print("With" if with_indexes else "Without", "the composite indexes:")
+        durations = (
+            ("latest", measure(latest, categories, earliest)),
+            ("category grep", measure(grep, categories, start, end)),
+            ("topic grep", measure(topic_grep, topics, start, end)),
+        )
+        for name, (duration, _) in durations:
+            print(f"{name:>15}: {duration / len(categories) * 1000:8.2f} ms per query")
+
+        query = (
+            m.Message.query.filter(
+                m.Message.category == categories[0], m.Message.timestamp > earliest
+            )
+            .order_by(m.Message.timestamp.desc())
+            .limit(1)
+        )
+        print("  latest plan:")
+        print(explain(query))
+        total, page, query = m.Message.grep(
+            categories=[categories[0]], start=start, end=end, defer=True
+        )
+        print("  category grep plan:")
+        print(explain(query))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+# This file is a part of datanommer, a message sink for fedmsg.
+# Copyright (C) 2014, Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+""" Compare the speed of the codecs available to serialize messages in the
+database, on the messages used by the datanommer.models tests.
+
+Usage: bench-codecs.py [number of iterations]
+"""
+import importlib.util
+import os
+import sys
+import timeit
+
+import datanommer.models as m
+
+
+def load_fixtures():
+    path = os.path.join(
+        os.path.dirname(__file__), "..", "datanommer.models", "tests", "test_model.py"
+    )
+    spec = importlib.util.spec_from_file_location("test_model", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    envelopes = [module.scm_message, module.github_message, module.umb_message]
+    return [envelope["body"]["msg"] for envelope in envelopes] + [
+        envelope["headers"] for envelope in envelopes if "headers" in envelope
+    ]
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    payloads = load_fixtures()
+    texts = [m.CODECS["fedmsg"].dumps(payload) for payload in payloads]
+    print(f"{len(payloads)} payloads of {sum(map(len, texts))} characters")
+
+    for name, codec in m.CODECS.items():
+        dumps = min(
+            timeit.repeat(
+                lambda: [codec.dumps(payload) for payload in payloads],
+                number=number,
+                repeat=3,
+            )
+        )
+        loads = min(
+            timeit.repeat(
+                lambda: [codec.loads(text) for text in texts], number=number, repeat=3
+            )
+        )
+        print(
+            f"{name:>10}: dumps {dumps / number / len(payloads) * 1e6:6.2f} µs, "
+            f"loads {loads / number / len(payloads) * 1e6:6.2f} µs per payload"
+        )
+
+
+if __name__ == "__main__":
+    main()
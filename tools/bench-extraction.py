@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+# This file is a part of datanommer, a message sink for fedmsg.
+# Copyright (C) 2014, Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+""" Compare the time it takes to extract the users and packages of a message
+with fedmsg.meta, with and without datanommer's topic to processor cache.
+
+Usage: bench-extraction.py [number of messages]
+"""
+import sys
+import timeit
+
+import fedmsg.config
+import fedmsg.meta
+
+import datanommer.models as m
+
+
+TOPICS = [
+    "org.fedoraproject.prod.git.receive",
+    "org.fedoraproject.prod.buildsys.tag",
+    "org.fedoraproject.prod.bodhi.update.comment",
+    "org.fedoraproject.prod.fas.user.update",
+    "org.fedoraproject.prod.copr.build.end",
+    "org.fedoraproject.prod.pagure.pull-request.new",
+    "org.fedoraproject.prod.wiki.article.edit",
+    "org.fedoraproject.prod.unknown.thing",
+]
+
+
+def make_messages(count):
+    return [
+        dict(
+            topic=TOPICS[i % len(TOPICS)],
+            i=i,
+            msg_id=str(i),
+            timestamp=1234,
+            msg=dict(agent="ralph", user="ralph", owner="ralph", name="dummy"),
+        )
+        for i in range(count)
+    ]
+
+
+def uncached(messages):
+    for message in messages:
+        fedmsg.meta.msg2usernames(message)
+        fedmsg.meta.msg2packages(message)
+
+
+def cached(messages):
+    for message in messages:
+        m._extract_names(message, message["msg_id"])
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    config = fedmsg.config.load_config([], None)
+    fedmsg.meta.make_processors(**config)
+    print(f"{len(fedmsg.meta.processors)} processors, {count} messages")
+
+    messages = make_messages(count)
+    for name, function in (("uncached", uncached), ("cached", cached)):
+        duration = min(timeit.repeat(lambda: function(messages), number=1, repeat=3))
+        print(f"{name:>10}: {duration / count * 1e6:8.1f} µs per message")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+# This file is a part of datanommer, a message sink for fedmsg.
+# Copyright (C) 2014, Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+""" Compare the user and package filters of Message.grep(), which are single
+semi-joins and anti-joins, with the correlated EXISTS subquery per name that
+they used to be.
+
+Usage: bench-grep-filters.py [number of messages] [database uri]
+
+Without a database uri, a synthetic SQLite database is created in a temporary
+directory.  With one, its existing messages are used.
+"""
+import datetime
+import random
+
+from benchlib import init, insert_messages, measure, message_row
+from sqlalchemy import not_, or_
+
+import datanommer.models as m
+
+
+NAMES = 1000
+
+
+def populate(count):
+    start = datetime.datetime(2020, 1, 1)
+    m.User.ensure(f"user{i}" for i in range(NAMES))
+    m.Package.ensure(f"package{i}" for i in range(NAMES))
+
+    def make_row(id_):
+        return message_row(
+            id_,
+            start + datetime.timedelta(seconds=id_),
+            "org.fedoraproject.prod.git.receive",
+            "git",
+        )
+
+    def associate(rows):
+        ids = [row["id"] for row in rows]
+        m.session.execute(
+            m.user_assoc_table.insert(),
+            [
+                {"username": f"user{name}", "msg": id_}
+                for id_ in ids
+                for name in set(random.sample(range(NAMES), random.randint(1, 3)))
+            ],
+        )
+        m.session.execute(
+            m.pack_assoc_table.insert(),
+            [
+                {"package": f"package{random.randrange(NAMES)}", "msg": id_}
+                for id_ in ids
+            ],
+        )
+
+    insert_messages(count, make_row, associate)
+
+
+def old_grep(users=None, not_users=None, rows_per_page=100):
+    query = m.Message.query
+    if users:
+        query = query.filter(
+            or_(*(m.Message.users.any(m.User.name == u) for u in users))
+        )
+    if not_users:
+        query = query.filter(
+            not_(or_(*(m.Message.users.any(m.User.name == u) for u in not_users)))
+        )
+    total = query.count()
+    messages = query.order_by(m.Message.timestamp).limit(rows_per_page).all()
+    return total, messages
+
+
+def new_grep(users=None, not_users=None, rows_per_page=100):
+    total, pages, messages = m.Message.grep(
+        users=users, not_users=not_users, rows_per_page=rows_per_page
+    )
+    return total, messages
+
+
+def main():
+    init(200000, populate)
+
+    users = [f"user{i}" for i in range(20)]
+    for name, kwargs in (
+        ("users", {"users": users}),
+        ("not_users", {"not_users": users}),
+    ):
+        old, (old_total, _) = measure(old_grep, **kwargs)
+        new, (new_total, _) = measure(new_grep, **kwargs)
+        assert old_total == new_total
+        print(
+            f"{name:>10} ({len(users)} names, {new_total} matches): "
+            f"EXISTS per name {old * 1000:8.1f} ms, semi-join {new * 1000:8.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
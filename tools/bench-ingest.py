@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+# This file is a part of datanommer, a message sink for fedmsg.
+# Copyright (C) 2014, Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+""" Compare how many messages per second datanommer stores with the ORM (one
+Message instance per message, as datanommer.models.add() used to do), with
+the Core insert path of add(), and with add_many().
+
+Usage: bench-ingest.py [number of messages] [database uri]
+
+The database defaults to an in-memory SQLite one, and its tables are created
+and dropped for each run.
+"""
+import datetime
+import sys
+import time
+
+import fedmsg.config
+import fedmsg.meta
+from sqlalchemy.orm import scoped_session
+
+import datanommer.models as m
+
+
+USERS = ["ralph", "pingou", "kevin", "nirik", "bowlofeggs"]
+PACKAGES = ["valgrind", "kernel", "python3", "firefox", "glibc", "gcc"]
+
+
+def make_messages(count):
+    return [
+        {
+            "body": {
+                "topic": "org.fedoraproject.prod.git.receive",
+                "i": 1,
+                "msg_id": f"2021-{i:08d}",
+                "timestamp": 1344350850 + i,
+                "msg": {
+                    "commit": {
+                        "username": USERS[i % len(USERS)],
+                        "repo": PACKAGES[i % len(PACKAGES)],
+                        "branch": "master",
+                        "rev": "7a98f80d9b61ce167e4ef8129c81ed9284ecf4e1",
+                        "message": "Some commit message\n" * 3,
+                        "stats": {"files": {"valgrind.spec": {"additions": 1}}},
+                    }
+                },
+            }
+        }
+        for i in range(count)
+    ]
+
+
+def add_with_orm(envelope):
+    message = envelope["body"]
+    obj = m.Message(
+        i=message.get("i", 0),
+        msg_id=message["msg_id"],
+        topic=message["topic"],
+        timestamp=datetime.datetime.utcfromtimestamp(message["timestamp"]),
+    )
+    obj.msg = message["msg"]
+    obj.headers = envelope.get("headers", None)
+    m.session.add(obj)
+    m.session.flush()
+
+    usernames, packages = m._extract_names(message, obj.msg_id)
+    for username in usernames:
+        m.User.get_or_create(username)
+    for package in packages:
+        m.Package.get_or_create(package)
+    m.session.flush()
+    values = [{"username": username, "msg": obj.id} for username in usernames]
+    if values:
+        m.session.execute(m.user_assoc_table.insert(), values)
+    values = [{"package": package, "msg": obj.id} for package in packages]
+    if values:
+        m.session.execute(m.pack_assoc_table.insert(), values)
+    m.session.commit()
+
+
+def orm(messages):
+    for envelope in messages:
+        add_with_orm(envelope)
+
+
+def core(messages):
+    for envelope in messages:
+        m.add(envelope)
+
+
+def bulk(messages):
+    for start in range(0, len(messages), 500):
+        m.add_many(messages[start : start + 500])
+
+
+def run(uri, function, messages):
+    m.session = scoped_session(m.maker)
+    m.init(uri, create=True)
+    try:
+        start = time.perf_counter()
+        function(messages)
+        duration = time.perf_counter() - start
+        assert m.Message.query.count() == len(messages)
+    finally:
+        m.session.rollback()
+        m.DeclarativeBase.metadata.drop_all(m.session.get_bind())
+        m.session.close()
+        m._users_seen.clear()
+        m._packages_seen.clear()
+    return duration
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    uri = sys.argv[2] if len(sys.argv) > 2 else "sqlite://"
+    config = fedmsg.config.load_config([], None)
+    fedmsg.meta.make_processors(**config)
+    print(f"{count} messages in {uri}")
+
+    messages = make_messages(count)
+    for name, function in (("orm", orm), ("add", core), ("add_many", bulk)):
+        duration = run(uri, function, messages)
+        print(f"{name:>10}: {count / duration:8.0f} messages per second")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+# This file is a part of datanommer, a message sink for fedmsg.
+# Copyright (C) 2014, Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+""" Compare the ways to find the latest message of each category, as
+datanommer-latest does by default: one query per category (as it used to),
+a ROW_NUMBER() window over the categories (DISTINCT ON behaves the same on
+PostgreSQL), a single query with a LIMIT 1 subquery per category, and
+Message.latest_by_category(), which reads the latest_category_messages table.
+
+Usage: bench-latest.py [number of messages] [database uri]
+
+Without a database uri, a synthetic SQLite database is created in a temporary
+directory.  With one, its existing messages are used.
+"""
+import datetime
+import random
+
+from benchlib import init, insert_messages, measure, message_row
+from sqlalchemy import func, select, union_all
+
+import datanommer.models as m
+
+
+CATEGORIES = [f"category{i}" for i in range(60)]
+
+
+def populate(count):
+    start = datetime.datetime.utcnow() - datetime.timedelta(minutes=count)
+
+    def make_row(id_):
+        # A few busy categories, like in production.
+        category = CATEGORIES[min(int(random.expovariate(0.2)), 59)]
+        timestamp = start + datetime.timedelta(minutes=id_)
+        topic = f"org.fedoraproject.prod.{category}.event"
+        return message_row(id_, timestamp, topic, category)
+
+    insert_messages(
+        count, make_row, lambda rows: m._update_latest(m.session.connection(), rows)
+    )
+
+
+def per_category(categories, since):
+    messages = []
+    for category in categories:
+        query = m.Message.query.filter(
+            m.Message.category == category, m.Message.timestamp > since
+        )
+        messages.extend(query.order_by(m.Message.timestamp.desc()).limit(1).all())
+    return messages
+
+
+def window(categories, since):
+    row_number = func.row_number().over(
+        partition_by=m.Message.category,
+        order_by=(m.Message.timestamp.desc(), m.Message.id.desc()),
+    )
+    ranked = (
+        select([m.Message.id, row_number.label("row_number")])
+        .where(m.Message.category.in_(categories), m.Message.timestamp > since)
+        .subquery()
+    )
+    latest = select([ranked.c.id]).where(ranked.c.row_number == 1)
+    return m.Message.query.filter(m.Message.id.in_(latest)).all()
+
+
+def single_query(categories, since):
+    latest = []
+    for category in categories:
+        subquery = (
+            select([m.Message.id])
+            .where(m.Message.category == category, m.Message.timestamp > since)
+            .order_by(m.Message.timestamp.desc(), m.Message.id.desc())
+        )
+        latest.append(select([subquery.limit(1).scalar_subquery()]))
+    return m.Message.query.filter(m.Message.id.in_(union_all(*latest))).all()
+
+
+def latest_table(categories, since):
+    return m.Message.latest_by_category(categories, since=since)
+
+
+def main():
+    if init(1000000, populate):
+        m.session.execute("ANALYZE")
+        categories = CATEGORIES
+    else:
+        categories = [
+            category for (category,) in m.session.query(m.Message.category).distinct()
+        ]
+
+    since = datetime.datetime.utcnow() - datetime.timedelta(days=365)
+    for name, function in (
+        ("per category", per_category),
+        ("window", window),
+        ("single query", single_query),
+        ("latest table", latest_table),
+    ):
+        duration, found = measure(function, categories, since, repeat=5)
+        print(f"{name:>15}: {duration * 1000:8.1f} ms for {len(found)} categories")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# This file is a part of datanommer, a message sink for fedmsg.
+# Copyright (C) 2014, Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+""" Helpers shared by the bench-*.py scripts that query a database of
+messages.
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+import datanommer.models as m
+
+
+def init(default_count, populate):
+    """Connect to the database given as the second command line argument.
+
+    Without one, create a SQLite database in a temporary directory and fill
+    it with populate(count), count being the first argument or default_count.
+    Returns whether the database was created.
+    """
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else default_count
+    if len(sys.argv) > 2:
+        m.init(sys.argv[2])
+        return False
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    m.init(f"sqlite:///{path}", create=True)
+    print(f"Creating {count} messages in {path}")
+    populate(count)
+    return True
+
+
+def message_row(id_, timestamp, topic, category):
+    """The columns of a synthetic message."""
+    return {
+        "id": id_,
+        "msg_id": str(id_),
+        "i": 1,
+        "topic": topic,
+        "category": category,
+        "timestamp": timestamp,
+        "_msg": "{}",
+    }
+
+
+def insert_messages(count, make_row, inserted=None, chunk_size=10000):
+    """Insert count messages, built by make_row(id_), chunk_size at a time.
+
+    inserted(rows) is called after each chunk is inserted.
+    """
+    random.seed(0)
+    for offset in range(0, count, chunk_size):
+        ids = range(offset + 1, min(count, offset + chunk_size) + 1)
+        rows = [make_row(id_) for id_ in ids]
+        m.session.execute(m.Message.__table__.insert(), rows)
+        if inserted is not None:
+            inserted(rows)
+    m.session.commit()
+
+
+def measure(function, *args, repeat=3, **kwargs):
+    """Return the shortest of repeat runs of function, and its result."""
+    durations = []
+    for _ in range(repeat):
+        m.session.expunge_all()
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        durations.append(time.perf_counter() - start)
+    return min(durations), result